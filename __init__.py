@@ -1 +1 @@
-from pyrbt import pyRBT,pyRBMap
+from pyrbt import pyRBT,pyRBMap,pyBPT,pyBPMap,pyRBJournal,pyRBTTLMap
@@ -15,11 +15,39 @@ from __future__ import print_function
 # Longest path is 2*B-1 nodes where B is the black depth of the tree
 # Shortest path is B nodes
 
+import heapq
+import os
+import pickle
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+try:
+  from collections.abc import MappingView, KeysView, ValuesView, ItemsView
+except ImportError:
+  from collections import MappingView, KeysView, ValuesView, ItemsView
+
+# Marks an argument that was not passed, where None is a valid value
+_NOTSET = object()
+
+class _Descending(object):
+  """ Wraps a key to invert its order, for max-heaps built on heapq """
+  __slots__ = ('k',)
+  def __init__(self,k): self.k = k
+  def __lt__(x,y): return y.k < x.k
+  def __eq__(x,y): return x.k == y.k
+
 class pyRBT(object):
-  __slots__ = ('root')
+  __slots__ = ('root','key','reverse','maxlen','evict','lazy','version','_bound',
+               '_index','_ndead','_changes')
 
   class RBLeaf(object):
     __slots__ = ('size','parent')
+    black = True # read-only, so fix-ups can test colour without a call
     def __init__(self,parent):
       self.size = 0
       self.parent = parent
@@ -34,14 +62,20 @@ class pyRBT(object):
         return ".["+pa+"]"
       else: return "."
 
+  # Every empty subtree is this one shared leaf. Its parent is scribbled on
+  # by rotations and splices but never read.
+  _leaf = RBLeaf(None)
+
   class RBNode(object):
-    __slots__ = ('value','black','size','l','r','parent')
-    def __init__(self,value,black=True):
+    __slots__ = ('value','key','black','dead','size','l','r','parent')
+    def __init__(self,value,black,key):
+      # key is the cached sort key of value, compared on every descent
       self.value = value
+      self.key = key
       self.black = black
-      self.size = 1
-      self.l = pyRBT.RBLeaf(self)
-      self.r = pyRBT.RBLeaf(self)
+      self.dead = False # deleted lazily, still in the tree for its key
+      self.size = 1 # number of live nodes in this subtree
+      self.l = self.r = pyRBT._leaf
       self.parent = None
     def isblack(self): return self.black
     def isred(self): return not self.black
@@ -81,12 +115,21 @@ class pyRBT(object):
           while not nxt.l.isleaf(): nxt = nxt.l
         else:
           while not nxt.r.isleaf(): nxt = nxt.r
+        if nxt.dead: nxt = pyRBT.RBTIterator.next_node(nxt,tree,self.fwd)
       self.nxt = nxt
     def __iter__(self): return self
     @staticmethod
     def next_node(node,tree,fwd,nxt=None):
+      """ Next live node after `node`, skipping lazily deleted nodes """
       if node is None: return nxt
-      elif fwd and not node.r.isleaf():
+      node = pyRBT.RBTIterator._step(node,fwd)
+      while node is not None and node.dead:
+        node = pyRBT.RBTIterator._step(node,fwd)
+      return node
+    @staticmethod
+    def _step(node,fwd):
+      """ Next node after `node` in order, dead or alive """
+      if fwd and not node.r.isleaf():
         # Take the secondary fork (right fork when forward)
         node = node.r
         while not node.l.isleaf(): node = node.l
@@ -127,10 +170,70 @@ class pyRBT(object):
     def __next__(self): return super(pyRBT.RBTValIterator,self).__next__().value
     def __prev__(self): return super(pyRBT.RBTValIterator,self).__prev__().value
 
-  def __init__(self,lst=None):
-    self.root = pyRBT.RBLeaf(None)
+  def __new__(cls,*args,**kwargs):
+    # engine='bplus' swaps in the B+ tree implementation of the same API
+    engine = args[5] if len(args) > 5 else kwargs.get('engine')
+    if engine == 'bplus':
+      cls = {pyRBT: pyBPT, pyRBMap: pyBPMap}.get(cls,cls)
+    return super(pyRBT,cls).__new__(cls)
+
+  def __init__(self,lst=None,key=None,reverse=False,maxlen=None,evict='min',
+               engine=None,hashindex=False,lazy=None,changelog=None):
+    """
+    :key function of one argument used to extract a comparison key from each
+         value, as with sorted(). Computed once per value and cached on its node.
+    :reverse True to order values from largest to smallest key
+    :maxlen if not None, the tree holds at most this many values
+    :evict which end to drop when a bounded tree is full: 'min' drops the
+           smallest key (keeps the largest), 'max' drops the largest key
+    :engine 'rbt' for a red-black tree, 'bplus' for a B+ tree (see pyBPT).
+            Defaults to the engine of this class.
+    :hashindex True to keep a dict from each (hashable) sort key to the first
+               node with that key, making exact-match lookups O(1) and
+               index() O(log N) without comparisons. Red-black engine only.
+    :lazy if not None, removing a value only marks its node dead, and the tree
+          is rebuilt without dead nodes (see compact()) once this fraction of
+          its nodes are dead. Must be in (0,1]. Red-black engine only. This
+          helps when removed keys are soon reinserted, which revives their
+          nodes. Plain removal is no faster than eager.
+    :changelog if not None, keep a log of up to this many of the most recent
+               changes, numbered by `version`, for changes_since()
+    """
+    native = 'bplus' if isinstance(self,pyBPT) else 'rbt'
+    if engine is None: engine = native
+    if engine != native:
+      raise ValueError("engine '"+str(engine)+"' not supported by "+type(self).__name__)
+    if hashindex and engine != 'rbt':
+      raise ValueError("hashindex is only supported by engine 'rbt'")
+    if lazy is not None:
+      if engine != 'rbt': raise ValueError("lazy is only supported by engine 'rbt'")
+      if not 0 < lazy <= 1: raise ValueError("lazy must be in (0,1]")
+    if maxlen is not None and maxlen < 0: raise ValueError("maxlen must be >= 0")
+    if changelog is not None and changelog < 0:
+      raise ValueError("changelog must be >= 0")
+    if evict not in ('min','max'): raise ValueError("evict must be 'min' or 'max'")
+    self.root = pyRBT._leaf
+    self.key = key
+    self.reverse = reverse
+    self.maxlen = maxlen
+    self.evict = evict
+    self.lazy = lazy
+    self._ndead = 0 # number of dead nodes still in the tree
+    self._bound = None # cached node evicted next when full
+    self._index = {} if hashindex else None # sort key -> first node with key
+    self.version = 0 # number of changes logged
+    self._changes = None if changelog is None else deque(maxlen=changelog)
     if lst is not None: self.extend(lst)
 
+  def _empty_like(self):
+    """ Return a new empty tree with the same type and ordering as this one """
+    return type(self)(key=self.key,reverse=self.reverse,
+                      hashindex=self._index is not None,lazy=self.lazy)
+
+  def _lt(self,a,b):
+    """ True if cached key `a` comes before cached key `b` in tree order """
+    return b < a if self.reverse else a < b
+
   def __len__(self):
     return self.root.size
 
@@ -173,11 +276,15 @@ class pyRBT(object):
       raise TypeError("Invalid argument type.")
 
   def __contains__(self,item):
-    return self.find(item) is not None
+    return self.findnode(item) is not None
 
   def clear(self):
     """ Reset the tree to an empty tree. """
-    self.root = pyRBT.RBLeaf(None)
+    self.root = pyRBT._leaf
+    self._bound = None
+    self._ndead = 0
+    if self._index is not None: self._index = {}
+    if self._changes is not None: self._logchange('clear',None)
 
   def __hash__(self):
     if len(self) == 0: return 0
@@ -201,52 +308,6 @@ class pyRBT(object):
   def __le__(x,y): return x.__cmp__(y) <= 0
   def __lt__(x,y): return x.__cmp__(y)  < 0
 
-  @staticmethod
-  def _grandparent(node):
-    return node.parent.parent if node.parent is not None else None
-
-  @staticmethod
-  def _uncle(node):
-    pa = node.parent
-    if pa is None: return None
-    gp = pa.parent
-    if gp is None: return None
-    return gp.r if pa == gp.l else gp.l
-
-  @staticmethod
-  def _sibling(node):
-    pa = node.parent
-    if pa is None: return None
-    return pa.r if pa.l == node else pa.l
-
-  def _replace_child_node(self,pa,ch,newch):
-    """
-    Replace child `ch` with `newch` in parent node `pa` and
-    update parent of `newch`
-    """
-    if pa is None: self.root = newch
-    elif pa.l is ch: pa.l = newch
-    elif pa.r is ch: pa.r = newch
-    else: raise Exception("No such child")
-    newch.parent = pa
-
-  def _swap_nodes(self, a, b):
-    """ Swap the positions of two nodes in the tree """
-    a.l,a.r,b.l,b.r, = b.l,b.r,a.l,a.r
-    a.parent,b.parent = b.parent,a.parent
-    # Keep size and black/red state with positions in tree
-    a.size,b.size = b.size,a.size
-    a.black,b.black = b.black,a.black
-    # Remove self loops if nodes connected
-    if a.parent is a: a.parent = b
-    if b.parent is b: b.parent = a
-    # register nodes with new parents (also resolves self-loops in children)
-    self._replace_child_node(b.parent,a,b)
-    self._replace_child_node(a.parent,b,a)
-    # # register nodes with new children
-    a.l.parent = a.r.parent = a
-    b.l.parent = b.r.parent = b
-
   def _rotate_left(self,node):
     """
     Rotate node.right child into parent position, and parent into old left pos.
@@ -257,12 +318,15 @@ class pyRBT(object):
        2    3  1    2
     pass pa node, returns ch node (new parent)
     """
-    pa, ch = node, node.r
-    pa.r, ch.l = ch.l, pa
-    ch.parent, pa.parent, pa.r.parent = pa.parent, ch, pa
-    pa.size = len(pa.l) + 1 + len(pa.r)
-    ch.size = len(ch.l) + 1 + len(ch.r)
-    self._replace_child_node(ch.parent, pa, ch)
+    pa,ch = node,node.r
+    mid,gp = ch.l,pa.parent
+    pa.r,ch.l = mid,pa
+    mid.parent,pa.parent,ch.parent = pa,ch,gp
+    # ch takes over pa's subtree; pa loses ch and its right subtree
+    pa.size,ch.size = pa.size - ch.size + mid.size,pa.size
+    if gp is None: self.root = ch
+    elif gp.l is pa: gp.l = ch
+    else: gp.r = ch
     return ch
 
   def _rotate_right(self,node):
@@ -276,84 +340,167 @@ class pyRBT(object):
     pass pa node, returns ch node (new parent)
     """
     pa,ch = node,node.l
-    pa.l, ch.r = ch.r, pa
-    ch.parent, pa.parent, pa.l.parent = pa.parent, ch, pa
-    pa.size = len(pa.l) + 1 + len(pa.r)
-    ch.size = len(ch.l) + 1 + len(ch.r)
-    self._replace_child_node(ch.parent, pa, ch)
+    mid,gp = ch.r,pa.parent
+    pa.l,ch.r = mid,pa
+    mid.parent,pa.parent,ch.parent = pa,ch,gp
+    pa.size,ch.size = pa.size - ch.size + mid.size,pa.size
+    if gp is None: self.root = ch
+    elif gp.l is pa: gp.l = ch
+    else: gp.r = ch
     return ch
 
-  def _insert_case1(self,node):
-    # print("  tree:",self,"  insert_case1:",node)
-    if node.parent is None:
-      self.root = node
-      self.root.black = True
-    elif node.parent.isred():
-      self._insert_case3(node)
-
-  def _insert_case3(self,node):
-    # print("  tree:",self,"  insert_case3:",node)
-    assert node.parent is not None and node.parent.isred()
-    # Assumption: parent exists and is red
-    #  => therefore grandparent also exists and is black
-    gp = pyRBT._grandparent(node)
-    un = pyRBT._uncle(node)
-    if un is not None and un.isred():
-      node.parent.black = True
-      un.black = True
-      gp.black = False
-      self._insert_case1(gp) # gp is now red, deal with it
-    else:
-      self._insert_case4(node)
-
-  def _insert_case4(self,node):
-    # print("  tree:",self,"  insert_case4:",node)
-    gp = pyRBT._grandparent(node)
-    pa = node.parent
-    if node == pa.r and pa == gp.l:
-      self._rotate_left(pa)
-      node = pa
-    elif node == pa.l and pa == gp.r:
-      self._rotate_right(pa)
-      node = pa
-    self._insert_case5(node)
-
-  def _insert_case5(self,node):
-    # print("  tree:",self,"  insert_case5:",node)
-    gp = pyRBT._grandparent(node)
-    pa = node.parent
-    gp.black = False
-    pa.black = True
-    if node == pa.l: self._rotate_right(gp)
-    else: self._rotate_left(gp)
+  def _insert_fixup(self,node):
+    """ Restore the red-black invariants after adding red `node` """
+    while True:
+      pa = node.parent
+      if pa is None:
+        node.black = True
+        return
+      if pa.black: return
+      # pa is red, so it is not the root and gp is black
+      gp = pa.parent
+      if pa is gp.l:
+        un = gp.r
+        if not un.black:
+          # red uncle: push gp's black down and carry on from gp
+          pa.black = un.black = True
+          gp.black = False
+          node = gp
+          continue
+        if node is pa.r:
+          self._rotate_left(pa)
+          pa = node
+        pa.black,gp.black = True,False
+        self._rotate_right(gp)
+      else:
+        un = gp.l
+        if not un.black:
+          pa.black = un.black = True
+          gp.black = False
+          node = gp
+          continue
+        if node is pa.l:
+          self._rotate_right(pa)
+          pa = node
+        pa.black,gp.black = True,False
+        self._rotate_left(gp)
+      return
 
   def insert(self,item,multiset=False):
     """
     Add an item into the tree.
     :multiset True allows multiple insertions of the same value
+    Returns None if the tree is bounded, full, and `item` falls outside the
+    retained range.
+    """
+    k = item if self.key is None else self.key(item)
+    node = self._insert(k,item,multiset)
+    return None if node is None else node.value
+
+  def _insert(self,k,item,multiset=False,replace=True):
+    """
+    Add `item` with precomputed sort key `k` into the tree.
+    Returns the node now holding `item`. If `replace` is False, an existing
+    node with an equal key is returned unchanged instead. Returns None if
+    `item` was rejected by a full bounded tree.
     """
-    if len(self) == 0: newv = self.root = pyRBT.RBNode(item)
+    if self._index is not None and not multiset:
+      node = self._index.get(k)
+      if node is not None:
+        if replace:
+          node.value,node.key = item,k
+          if self._changes is not None: self._logchange('set',item)
+        return node
+    bound = None
+    if self.maxlen is not None:
+      if len(self) >= self.maxlen:
+        bound = self._evict_bound(k,multiset)
+        if bound is None: return None
+      else: self._bound = None
+    if self.root.size == 0:
+      # any dead nodes left are dropped with the old root
+      newv = self.root = pyRBT.RBNode(item,True,k)
+      self._ndead = 0
+      if self._index is not None: self._index[k] = newv
+      if self._changes is not None: self._logchange('set',item)
     else:
-      # Add new node as a leaf node, then balance tree
+      # Add new node as a leaf node, then balance tree. One comparison per
+      # level: an equal key can only be the last node where we went right.
       node = self.root
-      while True:
-        if not multiset and item == node.value:
-          node.value = item
-          return node.value
-        nxt = (node.l if item < node.value else node.r)
-        if nxt.isleaf(): break
-        node = nxt
-      newv = pyRBT.RBNode(item,black=False)
-      newv.parent = node
-      if item < node.value: node.l = newv
-      else: node.r = newv
+      leaf = pyRBT._leaf
+      eq = None
+      if self.reverse:
+        while True:
+          if node.key < k: nxt,left = node.l,True
+          else: eq,nxt,left = node,node.r,False
+          if nxt is leaf: break
+          node = nxt
+      else:
+        while True:
+          if k < node.key: nxt,left = node.l,True
+          else: eq,nxt,left = node,node.r,False
+          if nxt is leaf: break
+          node = nxt
+      found = not multiset and eq is not None and eq.key == k
+      if found and eq.dead:
+        # replace a live node with this key before reviving the dead one
+        live = self._live_equal(eq)
+        if live is not None: eq = live
+      if found:
+        if not eq.dead:
+          if replace:
+            eq.value,eq.key = item,k
+            if self._changes is not None: self._logchange('set',item)
+          return eq
+        node = eq
+        # bring a lazily deleted node back to life
+        newv,newv.value,newv.dead = node,item,False
+        self._ndead -= 1
+      else:
+        newv = pyRBT.RBNode(item,False,k)
+        newv.parent = node
+        if left: node.l = newv
+        else: node.r = newv
       # Need to node update sizes
       while node is not None:
         node.size += 1
         node = node.parent
       # Re-balance tree
-      self._insert_case1(newv)
-    return newv.value
+      if not found: self._insert_fixup(newv)
+      # multiset values go after equal keys, so only a new key is indexed
+      if self._index is not None and k not in self._index: self._index[k] = newv
+      if self._changes is not None: self._logchange('set',item)
+      if bound is not None:
+        # full bounded tree: drop the boundary node, its neighbour replaces it
+        nxt = pyRBT.RBTIterator.next_node(bound,self,self._evict_first())
+        self._delete_node(bound)
+        self._bound = nxt
+    return newv
+
+  def _evict_bound(self,k,multiset):
+    """
+    Compare key `k` against the cached boundary of a full bounded tree.
+    Returns the boundary node to evict, or None if `k` should be rejected.
+    """
+    if self.maxlen == 0: return None
+    first = self._evict_first()
+    bound = self._bound
+    if bound is None:
+      bound = self.root
+      if first:
+        while not bound.l.isleaf(): bound = bound.l
+      else:
+        while not bound.r.isleaf(): bound = bound.r
+      if bound.dead: bound = pyRBT.RBTIterator.next_node(bound,self,first)
+      self._bound = bound
+    bk = bound.key
+    if multiset and k == bk: return None
+    outside = self._lt(k,bk) if first else self._lt(bk,k)
+    return None if outside else bound
+
+  def _evict_first(self):
+    """ True if a full bounded tree evicts its first node in tree order """
+    return (self.evict == 'min') != bool(self.reverse)
 
   def extend(self,l,multiset=False):
     """ Insert all the items form list l. """
@@ -371,89 +518,98 @@ class pyRBT(object):
     if node is None: raise KeyError("RBT key '"+str(item)+"' not found")
     return self._delete_node(node)
 
-  @staticmethod
-  def _adjacent_node(node):
-    """ Fetch an adjacent node on either the left or right of a node. """
-    if not node.l.isleaf():
-      # adjacent node to the left
-      node = node.l
-      while not node.r.isleaf(): node = node.r
-    elif not node.r.isleaf():
-      # adjacent node to the right
-      node = node.r
-      while not node.l.isleaf(): node = node.l
-    return node
-
   def _delete_node(self,node):
-    # Find bottom internal node to swap with
-    adjnode = pyRBT._adjacent_node(node)
-    # swap node to the bottom of the tree
-    if adjnode is not node: self._swap_nodes(adjnode,node)
-    for v in node.path(): v.size -= 1
-    self._delete_node_with_one_child(node)
-    return node.value
-
-  def _delete_node_with_one_child(self,node):
-    """ Delete node with at most one child. """
-    child = (node.l if node.r.isleaf() else node.r)
-    self._replace_child_node(node.parent, node, child)
-    # may be appending a leaf node, this is OK in deletion
-    if node.isblack():
-      if child.isred(): child.black = True
-      else: self._delete_case2(child)
-    # `node` is no longer in the tree
-
-  # assume we have a parent
-  def _delete_case2(self,node):
-    if node.parent is None: return
-    (pa,nd,sb) = (node.parent,node,pyRBT._sibling(node))
-    if sb.isred():
-      pa.black = False
-      sb.black = True
-      if nd == pa.l: self._rotate_left(pa)
-      else: self._rotate_right(pa)
-    self._delete_case3(node)
-
-  def _delete_case3(self,node):
-    (pa,sb) = (node.parent,pyRBT._sibling(node))
-    if pa.isblack() and sb.isblack() and sb.l.isblack() and sb.r.isblack():
-      sb.black = False
-      self._delete_case2(pa)
+    if self._changes is not None: self._logchange('del',node.value)
+    if self._index is not None and self._index.get(node.key) is node:
+      # the next node becomes the first with this key, if it has the same key
+      nxt = pyRBT.RBTIterator.next_node(node,self,True)
+      if nxt is not None and nxt.key == node.key: self._index[node.key] = nxt
+      else: del self._index[node.key]
+    if self.lazy is not None:
+      value,node.value,node.dead = node.value,None,True
+      v = node
+      while v is not None:
+        v.size -= 1
+        v = v.parent
+      self._ndead += 1
+      if node is self._bound: self._bound = None
+      if self._ndead >= self.lazy * (len(self) + self._ndead): self.compact()
+      return value
+    leaf = pyRBT._leaf
+    gp = node.parent
+    if node.l is leaf or node.r is leaf:
+      # splice out node, which has at most one child
+      child = node.l if node.r is leaf else node.r
+      pa,black,top = gp,node.black,child
     else:
-      self._delete_case4(node)
+      # move the previous node (no right child) into node's place, so both
+      # keep their identity for iterators and the hash index
+      top = node.l
+      while top.r is not leaf: top = top.r
+      child,pa,black = top.l,top.parent,top.black
+      if pa is node: pa = top
+      else:
+        pa.r,top.l = child,node.l
+        top.l.parent = top
+      top.r = node.r
+      top.r.parent = top
+      top.black,top.size = node.black,node.size
+    if gp is None: self.root = top
+    elif gp.l is node: gp.l = top
+    else: gp.r = top
+    top.parent = gp
+    child.parent = pa
+    v = pa
+    while v is not None:
+      v.size -= 1
+      v = v.parent
+    if black:
+      if not child.black: child.black = True
+      elif pa is not None: self._delete_fixup(child,pa)
+    if node is self._bound: self._bound = None
+    return node.value
 
-  def _delete_case4(self,node):
-    (pa,nd,sb) = (node.parent,node,pyRBT._sibling(node))
-    if pa.isred() and sb.isblack() and sb.l.isblack() and sb.r.isblack():
-      sb.black = False
-      pa.black = True
-    else:
-      self._delete_case5(node)
-
-  def _delete_case5(self,node):
-    (pa,nd,sb) = (node.parent,node,pyRBT._sibling(node))
-    if sb.isblack():
-      if nd == pa.l and sb.r.isblack() and sb.l.isred():
-        sb.black = False
-        sb.l.black = True
-        self._rotate_right(sb)
-      elif nd == pa.r and sb.l.isblack() and sb.r.isred():
-        sb.black = False
-        sb.r.black = True
-        self._rotate_left(sb)
-    self._delete_case6(node)
-
-  def _delete_case6(self,node):
-    (pa,nd,sb) = (node.parent,node,pyRBT._sibling(node))
-    sb.black = pa.black
-    pa.black = True
-    if nd == pa.l:
-      sb.r.black = True
-      self._rotate_left(pa)
-    else:
-      assert nd == pa.r
-      sb.l.black = True
-      self._rotate_right(pa)
+  def _delete_fixup(self,node,pa):
+    """
+    Restore the red-black invariants after removing a black node from under
+    `pa`, leaving `node` (maybe the shared leaf) one black node short.
+    """
+    while pa is not None and node.black:
+      if node is pa.l:
+        sb = pa.r
+        if not sb.black:
+          sb.black,pa.black = True,False
+          self._rotate_left(pa)
+          sb = pa.r
+        if sb.l.black and sb.r.black:
+          # sibling can turn red; the shortfall moves up to pa
+          sb.black = False
+          node,pa = pa,pa.parent
+          continue
+        if sb.r.black:
+          sb.l.black,sb.black = True,False
+          self._rotate_right(sb)
+          sb = pa.r
+        sb.black,pa.black,sb.r.black = pa.black,True,True
+        self._rotate_left(pa)
+      else:
+        sb = pa.l
+        if not sb.black:
+          sb.black,pa.black = True,False
+          self._rotate_right(pa)
+          sb = pa.l
+        if sb.l.black and sb.r.black:
+          sb.black = False
+          node,pa = pa,pa.parent
+          continue
+        if sb.l.black:
+          sb.r.black,sb.black = True,False
+          self._rotate_left(sb)
+          sb = pa.l
+        sb.black,pa.black,sb.l.black = pa.black,True,True
+        self._rotate_right(pa)
+      return
+    if not node.black: node.black = True
 
   def find(self,item):
     """ Find a given item in the tree. Returns None if not found. """
@@ -462,12 +618,98 @@ class pyRBT(object):
 
   def findnode(self,item,node=None):
     """ Find the node holding a given value. Returns None if not found. """
-    if node is None: node = self.root
-    while not node.isleaf():
-      if item == node.value: return node
-      node = (node.l if item < node.value else node.r)
+    k = item if self.key is None else self.key(item)
+    if node is None:
+      if self._index is not None: return self._index.get(k)
+      node = self.root
+    # One comparison per level: an equal key can only be the last node where
+    # the descent went right
+    leaf = pyRBT._leaf
+    eq = None
+    if self.reverse:
+      while node is not leaf:
+        if node.key < k: node = node.l
+        else: eq,node = node,node.r
+    else:
+      while node is not leaf:
+        if k < node.key: node = node.l
+        else: eq,node = node,node.r
+    if eq is None or eq.key != k: return None
+    if eq.dead: return self._live_equal(eq)
+    return eq
+
+  def _live_equal(self,node):
+    """
+    Last live node with the same key as `node`, a dead node that is the last
+    with its key, or None. Walks back through the run of equal keys, which
+    is just `node` unless the tree holds a multiset.
+    """
+    k = node.key
+    step = pyRBT.RBTIterator._step
+    node = step(node,False)
+    while node is not None and node.key == k:
+      if not node.dead: return node
+      node = step(node,False)
     return None
 
+  def _floornode(self,item,inclusive=True):
+    """
+    Find the last node at or before `item` in tree order (strictly before if
+    not `inclusive`). Returns None if there is no such node.
+    """
+    k = item if self.key is None else self.key(item)
+    rev = self.reverse
+    node,best = self.root,None
+    while not node.isleaf():
+      nk = node.key
+      if ((nk < k) if rev else (k < nk)) or (not inclusive and k == nk):
+        node = node.l
+      else:
+        best,node = node,node.r
+    if best is not None and best.dead:
+      best = pyRBT.RBTIterator.next_node(best,self,False)
+    return best
+
+  def _ceilingnode(self,item,inclusive=True):
+    """
+    Find the first node at or after `item` in tree order (strictly after if
+    not `inclusive`). Returns None if there is no such node.
+    """
+    k = item if self.key is None else self.key(item)
+    rev = self.reverse
+    node,best = self.root,None
+    while not node.isleaf():
+      nk = node.key
+      if ((k < nk) if rev else (nk < k)) or (not inclusive and k == nk):
+        node = node.r
+      else:
+        best,node = node,node.l
+    if best is not None and best.dead:
+      best = pyRBT.RBTIterator.next_node(best,self,True)
+    return best
+
+  def _irange_nodes(self,lo=None,hi=None,inclusive=(True,True),reverse=False):
+    """
+    Generator over nodes from `lo` to `hi` in tree order. A bound of None is
+    unbounded. Does one descent to find the first node then walks successors.
+    """
+    if not reverse:
+      stop,inc = hi,inclusive
+      node = (next(self.nodes(),None) if lo is None
+              else self._ceilingnode(lo,inclusive[0]))
+    else:
+      stop,inc = lo,(inclusive[1],inclusive[0])
+      node = (next(self.nodes(True),None) if hi is None
+              else self._floornode(hi,inclusive[1]))
+    if stop is not None:
+      sk = stop if self.key is None else self.key(stop)
+    while node is not None:
+      if stop is not None:
+        past = self._lt(node.key,sk) if reverse else self._lt(sk,node.key)
+        if past or (not inc[1] and node.key == sk): return
+      yield node
+      node = pyRBT.RBTIterator.next_node(node,self,not reverse)
+
   def get(self,i,start=None):
     """ Fetch item via index. Index is within `start` if passed """
     node = self.getnode(i,start)
@@ -480,73 +722,404 @@ class pyRBT(object):
     if i < 0 or i >= len(node):
       raise IndexError("index out of range (%d vs 0..%d)" % (i, len(node)))
     while not node.isleaf():
-      if i < len(node.l): node = node.l
-      elif i == len(node.l): return node
+      nl = len(node.l)
+      if i < nl: node = node.l
+      elif i == nl and not node.dead: return node
       else:
-        i -= len(node.l) + 1
+        i -= nl + (0 if node.dead else 1)
         node = node.r
     raise RuntimeError("Internal pyRBT error")
 
   def index(self,item,start=None):
     """ Get the first index of an given value """
     node = self.root if start is None else start
+    k = item if self.key is None else self.key(item)
+    if self._index is not None and start is None:
+      node = self._index.get(k)
+      if node is None: raise KeyError('Key not found: '+str(item))
+      return pyRBT._rank(node)
+    rev = self.reverse
     i = 0
-    idx = None
+    idx,first = None,None
     while not node.isleaf():
-      if item < node.value: node = node.l
-      elif item == node.value:
+      nk = node.key
+      if (nk < k) if rev else (k < nk): node = node.l
+      elif k == nk:
         # found one instance, look for earlier ones
-        idx = i+len(node.l)
+        idx,first = i+len(node.l),node
         node = node.l
       else:
-        i += len(node.l) + 1
+        i += len(node.l) + (0 if node.dead else 1)
         node = node.r
+    if first is not None and first.dead:
+      # dead nodes take no index, so the next live one has the same index
+      first = pyRBT.RBTIterator.next_node(first,self,True)
+      if first is None or first.key != k: idx = None
     if idx is None: raise KeyError('Key not found: '+str(item))
     return idx
 
+  def rank(self,item):
+    """
+    Number of values before `item` in tree order, whether or not `item` is in
+    the tree, i.e. the index it has or would have. O(log N).
+    """
+    node = self._ceilingnode(item)
+    return len(self) if node is None else pyRBT._rank(node)
+
+  def _nodes_between_ranks(self,i,j):
+    """ Generator over the nodes at indices i..j-1, walking successors """
+    if i >= j: return
+    node = self.getnode(i)
+    for _ in range(j-i):
+      yield node
+      node = pyRBT.RBTIterator.next_node(node,self,True)
+
+  @staticmethod
+  def _rank(node):
+    """ Index of `node` in its tree, found by walking up to the root """
+    i = len(node.l)
+    while node.parent is not None:
+      pa = node.parent
+      if node is pa.r: i += len(pa.l) + (0 if pa.dead else 1)
+      node = pa
+    return i
+
+  def compact(self):
+    """
+    Rebuild the tree without its dead nodes in O(N). Live node objects are
+    relinked rather than copied, so iterators and the hash index stay valid.
+    """
+    nodes = list(self.nodes())
+    n = len(nodes)
+    depth = n.bit_length()
+    full = (n == (1 << depth) - 1)
+    # same shape and colouring as _bulk_load()
+    def build(lo,hi,level,parent):
+      if lo == hi: return pyRBT._leaf
+      mid = (lo+hi)//2
+      node = nodes[mid]
+      node.black = full or level < depth
+      node.parent,node.size = parent,hi-lo
+      node.l = build(lo,mid,level+1,node)
+      node.r = build(mid+1,hi,level+1,node)
+      return node
+    self.root = build(0,n,1,None)
+    self._ndead = 0
+
+  def _bulk_load(self,keys,items):
+    """
+    Replace the contents of the tree with `items`, which must already be in
+    tree order, with sort keys `keys`. Builds a balanced tree in O(N).
+    """
+    n = len(items)
+    depth = n.bit_length() # number of levels in the tree
+    full = (n == (1 << depth) - 1)
+    # nodes on an incomplete bottom level are red, so every path from the
+    # root passes through the same number of black nodes
+    def build(lo,hi,level,parent):
+      if lo == hi: return pyRBT._leaf
+      mid = (lo+hi)//2
+      node = pyRBT.RBNode(items[mid],black=(full or level < depth),key=keys[mid])
+      node.parent = parent
+      node.size = hi-lo
+      node.l = build(lo,mid,level+1,node)
+      node.r = build(mid+1,hi,level+1,node)
+      return node
+    self.root = build(0,n,1,None)
+    self._bound = None
+    self._ndead = 0
+    if self._index is not None:
+      self._index = {}
+      for node in self.nodes(): self._index.setdefault(node.key,node)
+    if self._changes is not None: self._logload(items)
+
+  @staticmethod
+  def _black_height(node):
+    """ Number of black nodes on the path from `node` down to a leaf """
+    h = 0
+    while not node.isleaf():
+      if node.black: h += 1
+      node = node.l
+    return h
+
+  def _join(self,tl,node,tr):
+    """
+    Join the trees rooted at tl and tr (black or leaf roots, no parents) with
+    `node`, whose key lies between them. Uses self.root as scratch space and
+    returns the new root. Runs in O(difference in black height).
+    """
+    hl,hr = pyRBT._black_height(tl),pyRBT._black_height(tr)
+    if hl == hr:
+      node.l,node.r,node.parent,node.black = tl,tr,None,True
+      node.size = len(tl) + 1 + len(tr)
+      tl.parent = tr.parent = node
+      self.root = node
+      return node
+    # Hang node off the spine of the taller tree, at a black node c with the
+    # same black height as the shorter tree, then fix up as for insertion
+    taller,h,hshort,right = (tl,hl,hr,True) if hl > hr else (tr,hr,hl,False)
+    self.root = c = taller
+    pa = None # tracked, as the shared leaf does not know its parent
+    while c.isred() or h > hshort:
+      if c.isblack(): h -= 1
+      pa,c = c,(c.r if right else c.l)
+    if right: pa.r,node.l,node.r = node,c,tr
+    else: pa.l,node.l,node.r = node,tl,c
+    node.parent,node.black = pa,False
+    node.l.parent = node.r.parent = node
+    node.size = len(node.l) + 1 + len(node.r)
+    grow = len(tr if right else tl) + 1
+    for v in pa.path(): v.size += grow
+    self._insert_fixup(node)
+    return self.root
+
+  def _split(self,pred):
+    """
+    Split off the nodes whose keys satisfy pred, which must hold for a prefix
+    of the tree. Returns them as a new tree, leaving the rest in this tree.
+    Runs in O(log^2 N) by cutting the search path and joining the pieces.
+    """
+    def split(node):
+      """ Returns roots of (prefix, rest) of the subtree at `node` """
+      if node.isleaf(): return (node,node)
+      l,r = node.l,node.r
+      for ch in (l,r):
+        ch.parent = None
+        if not ch.isleaf(): ch.black = True
+      if pred(node.key):
+        rl,rr = split(r)
+        return (self._join(l,node,rl),rr)
+      else:
+        ll,lr = split(l)
+        return (ll,self._join(lr,node,r))
+    if self._ndead > 0: self.compact() # _join assumes every node is live
+    left = self._empty_like()
+    left.root,self.root = split(self.root)
+    self._bound = None
+    if self._index is not None:
+      for node in left.nodes():
+        # a key's run of nodes may be cut in two
+        if self._index.get(node.key) is node:
+          del self._index[node.key]
+          if len(self) > 0:
+            first = self.getnode(0)
+            if first.key == node.key: self._index[node.key] = first
+        left._index.setdefault(node.key,node)
+    if self._changes is not None:
+      for node in left.nodes(): self._logchange('del',node.value)
+    return left
+
+  def _logchange(self,op,item):
+    """ Record a change of `op` 'set', 'del' or 'clear' to `item` """
+    self.version += 1
+    self._changes.append((op,item))
+
+  def _logload(self,items):
+    """ Record the contents of the tree being replaced by `items` """
+    self._logchange('clear',None)
+    for item in items: self._logchange('set',item)
+
+  def _change(self,op,item):
+    """ Change to `item` as an (op,k,v) tuple """
+    return (op,item,None)
+
+  def _change_item(self,k,v):
+    """ Item stored for a ('set',k,v) change """
+    return k
+
+  def changes_since(self,version):
+    """
+    List of changes made after `version` (compare with `tree.version`),
+    oldest first, as (op,k,v) tuples for apply(). op is 'set', 'del' or
+    'clear'. For a pyRBT k is the value and v is None; for a pyRBMap, k and
+    v are the key and value ('del' has v None). Raises ValueError if the
+    change log is off or no longer reaches back to `version`.
+    """
+    if self._changes is None: raise ValueError("tree has no change log")
+    n = self.version - version
+    if n < 0 or n > len(self._changes):
+      raise ValueError("changes since version "+str(version)+" not available")
+    start = len(self._changes) - n
+    return [ self._change(op,item) for (op,item) in islice(self._changes,start,None) ]
+
+  def diff_against(self,other):
+    """
+    Changes that turn `other` into a copy of this tree, as (op,k,v) tuples
+    for apply(). Found in one merged pass over both trees in O(N+M); they
+    must share a key function.
+    """
+    changes = []
+    ai,bi = self.nodes(),other.nodes(bool(other.reverse) != bool(self.reverse))
+    a,b = next(ai,None),next(bi,None)
+    while a is not None or b is not None:
+      if b is None or (a is not None and self._lt(a.key,b.key)):
+        changes.append(self._change('set',a.value))
+        a = next(ai,None)
+      elif a is None or self._lt(b.key,a.key):
+        changes.append(other._change('del',b.value))
+        b = next(bi,None)
+      else:
+        mine = self._change('set',a.value)
+        if mine != other._change('set',b.value): changes.append(mine)
+        a,b = next(ai,None),next(bi,None)
+    return changes
+
+  def apply(self,changes):
+    """
+    Apply (op,k,v) changes from changes_since() or diff_against(). Only the
+    last change to each key counts. The rest are sorted into tree order and
+    applied one by one, or, when they touch a large part of an unbounded
+    tree, merged with it in one pass and bulk loaded in O(N).
+    """
+    changes = list(changes)
+    for i in range(len(changes)-1,-1,-1):
+      if changes[i][0] == 'clear':
+        self.clear()
+        changes = changes[i+1:]
+        break
+    key = (lambda x: x) if self.key is None else self.key
+    batch = [ (key(k),op,k,v) for (op,k,v) in changes ]
+    # stable sort, so the last change to a key ends its run
+    batch.sort(key=lambda c: c[0],reverse=bool(self.reverse))
+    batch = [ c for (i,c) in enumerate(batch)
+              if i+1 == len(batch) or batch[i+1][0] != c[0] ]
+    if self.maxlen is None and 4*len(batch) >= len(self):
+      keys,items = [],[]
+      nodes = self.nodes()
+      node = next(nodes,None)
+      for (sk,op,k,v) in batch:
+        while node is not None and self._lt(node.key,sk):
+          keys.append(node.key)
+          items.append(node.value)
+          node = next(nodes,None)
+        if node is not None and node.key == sk: node = next(nodes,None)
+        if op == 'set':
+          keys.append(sk)
+          items.append(self._change_item(k,v))
+      while node is not None:
+        keys.append(node.key)
+        items.append(node.value)
+        node = next(nodes,None)
+      # log the changes themselves rather than the whole new contents
+      log,self._changes = self._changes,None
+      self._bulk_load(keys,items)
+      self._changes = log
+      if log is not None:
+        for (sk,op,k,v) in batch:
+          self._logchange(op,self._change_item(k,v))
+    else:
+      for (sk,op,k,v) in batch:
+        if op == 'set': self._insert(sk,self._change_item(k,v))
+        else:
+          node = self.findnode(k)
+          if node is not None: self._delete_node(node)
+
+  @staticmethod
+  def _merge_nodes(trees,desc,dedup):
+    """
+    Generator merging the nodes of `trees` by key, in descending key order if
+    `desc`. Equal keys come out in the order of their trees. If `dedup`, only
+    the last node of each run of equal keys is returned.
+    """
+    heap = []
+    for (i,t) in enumerate(trees):
+      it = t.nodes(bool(t.reverse) != desc)
+      node = next(it,None)
+      if node is not None:
+        heap.append((_Descending(node.key) if desc else node.key,i,node,it))
+    heapq.heapify(heap)
+    prev = None
+    while heap:
+      (k,i,node,it) = heap[0]
+      nxt = next(it,None)
+      if nxt is None: heapq.heappop(heap)
+      else:
+        heapq.heapreplace(heap,(_Descending(nxt.key) if desc else nxt.key,
+                                i,nxt,it))
+      if not dedup: yield node
+      else:
+        if prev is not None and prev.key != node.key: yield prev
+        prev = node
+    if prev is not None: yield prev
+
+  @staticmethod
+  def merge(*trees,**kwargs):
+    """
+    Lazily merge the values of several trees into one ordered stream, with a
+    heap over their iterators: O(N log k) for N values in k trees. The trees
+    must share a key function; the order is that of the first tree.
+    :reverse True to merge in reverse order
+    :dedup True to return only the last of each run of equal keys, so values
+           in later trees replace those in earlier ones, as in union()
+    """
+    reverse = kwargs.pop('reverse',False)
+    dedup = kwargs.pop('dedup',False)
+    if kwargs: raise TypeError("Unexpected argument '"+next(iter(kwargs))+"'")
+    if len(trees) == 0: return iter(())
+    nodes = pyRBT._merge_nodes(trees,bool(trees[0].reverse) != bool(reverse),dedup)
+    if isinstance(trees[0],pyRBMap): return ((n.value.k,n.value.v) for n in nodes)
+    return (n.value for n in nodes)
+
+  @classmethod
+  def merged(cls,*trees,**kwargs):
+    """
+    Return a new tree, ordered like the first of `trees`, holding the values
+    of all of them. Merges their iterators then builds the tree in O(N),
+    without inserting values one at a time.
+    :dedup as in merge(), default True. Pass False to keep every value from
+           multiset trees.
+    """
+    dedup = kwargs.pop('dedup',True)
+    if kwargs: raise TypeError("Unexpected argument '"+next(iter(kwargs))+"'")
+    if len(trees) == 0: return cls()
+    tree = trees[0]._empty_like()
+    keys,items = [],[]
+    for node in pyRBT._merge_nodes(trees,bool(tree.reverse),dedup):
+      keys.append(node.key)
+      items.append(node.value)
+    tree._bulk_load(keys,items)
+    return tree
+
   def union(self,other):
     """ Return a tree that is the union of this tree and other """
-    tree = pyRBT()
-    tree.extend(self)
-    tree.extend(other)
-    return tree
+    return self.merged(self,other)
 
   def diff(self,other):
     """ Return a tree contain elements from this tree not in other tree """
-    tree = pyRBT()
-    for x in self:
-      if x not in other:
-        tree.insert(x)
+    tree = self._empty_like()
+    ai,bi = self.nodes(),other.nodes(bool(other.reverse) != bool(self.reverse))
+    b = next(bi,None)
+    for a in ai:
+      while b is not None and self._lt(b.key,a.key): b = next(bi,None)
+      if b is None or a.key != b.key: tree._insert(a.key,a.value)
     return tree
 
   def intersect(self,other):
     """ Return a tree that is the intersection of this tree and other """
-    tree = pyRBT()
-    ai,bi = iter(self),iter(other)
+    tree = self._empty_like()
+    ai,bi = self.nodes(),other.nodes(bool(other.reverse) != bool(self.reverse))
     try:
       a,b = next(ai),next(bi)
       while True:
-        if a==b:
-          tree.insert(a)
+        if a.key == b.key:
+          tree._insert(a.key,a.value)
           a,b = next(ai),next(bi)
-        elif a < b: a = next(ai)
+        elif self._lt(a.key,b.key): a = next(ai)
         else: b = next(bi)
     except StopIteration: pass
     return tree
 
   def symmetric_diff(self,other):
     """ Return a tree that contains elements that are only in one of self,other. """
-    tree = pyRBT()
-    ai,bi = iter(self),iter(other)
-    try:
-      a,b = next(ai),next(bi)
-      while True:
-        if a==b: a,b = next(ai),next(bi)
-        elif a < b: tree.insert(a); a = next(ai)
-        else: tree.insert(b); b = next(bi)
-    except StopIteration: pass
-    tree.extend(ai)
-    tree.extend(bi)
+    tree = self._empty_like()
+    ai,bi = self.nodes(),other.nodes(bool(other.reverse) != bool(self.reverse))
+    a,b = next(ai,None),next(bi,None)
+    while a is not None and b is not None:
+      if a.key == b.key: a,b = next(ai,None),next(bi,None)
+      elif self._lt(a.key,b.key): tree._insert(a.key,a.value); a = next(ai,None)
+      else: tree._insert(b.key,b.value); b = next(bi,None)
+    while a is not None: tree._insert(a.key,a.value); a = next(ai,None)
+    while b is not None: tree._insert(b.key,b.value); b = next(bi,None)
     return tree
 
   def check(self):
@@ -554,8 +1127,20 @@ class pyRBT(object):
     assert (len(self) == 0) == self.root.isleaf() # size is zero only if empty
     assert self.root.isblack() # root node is black
     nblack = -1
-    nnodes = 0
-    for node in self.nodes():
+    nnodes = ndead = 0
+    prev = None
+    node = self.root
+    if not node.isleaf():
+      while not node.l.isleaf(): node = node.l
+    else: node = None
+    # visit every node, including dead ones
+    while node is not None:
+      # nodes are in order of their cached keys
+      assert prev is None or not self._lt(node.key,prev.key)
+      assert node.size == len(node.l) + (0 if node.dead else 1) + len(node.r)
+      assert node.l.isleaf() or node.l.parent is node
+      assert node.r.isleaf() or node.r.parent is node
+      prev = node
       # print("Check:",'->'.join([str(x) for x in p]))
       assert not node.isleaf() or node.isblack() # all leaf nodes are black
       if node.isred():
@@ -566,8 +1151,18 @@ class pyRBT(object):
         ntmpb = sum([ x.isblack() for x in node.path() ]) + 1
         assert nblack == -1 or nblack == ntmpb
         nblack = ntmpb
-      nnodes += 1
+      if node.dead: ndead += 1
+      else: nnodes += 1
+      node = pyRBT.RBTIterator._step(node,True)
     assert nnodes == len(self)
+    assert ndead == self._ndead
+    assert ndead == 0 or ndead < self.lazy * (nnodes + ndead)
+    assert self.maxlen is None or len(self) <= self.maxlen
+    if self._index is not None:
+      firsts = {}
+      for node in self.nodes(): firsts.setdefault(node.key,node)
+      assert len(firsts) == len(self._index)
+      for (k,node) in firsts.items(): assert self._index[k] is node
     # print('nblack:',nblack,'nnodes:',nnodes)
 
 class pyRBMap(pyRBT):
@@ -590,10 +1185,66 @@ class pyRBMap(pyRBT):
       x = super(pyRBMap.RBMapIterator,self).__prev__().value
       return (x.k, x.v)
     def insert(self,k,v):
-      return super(pyRBMap.RBMapIterator,self).insert(RBKeyValue(k,v))
+      return self.tree.insert(k,v)
 
-  def __init__(self,h=None):
-    super(pyRBMap,self).__init__()
+  class RBMapView(MappingView):
+    """
+    Base of the ordered views onto a pyRBMap, backed by the tree. Supports
+    iteration in either direction and O(log N) positional indexing with
+    view[i]. Each view class defines _item(node), the element it yields.
+    """
+    __slots__ = ('_reverse',)
+    def __init__(self,mapping,reverse=False):
+      self._mapping = mapping
+      self._reverse = reverse
+    def __len__(self): return len(self._mapping)
+    def __iter__(self):
+      for node in self._mapping.nodes(self._reverse): yield self._item(node)
+    def __reversed__(self):
+      for node in self._mapping.nodes(not self._reverse): yield self._item(node)
+    def __getitem__(self,i):
+      if isinstance(i, slice):
+        return [ self[j] for j in range(*i.indices(len(self))) ]
+      n = len(self._mapping)
+      if i < 0: i += n
+      if i < 0 or i >= n:
+        raise IndexError("index out of range (%d vs 0..%d)" % (i, n))
+      return self._item(self._mapping.getnode(n-1-i if self._reverse else i))
+    def __repr__(self):
+      return type(self).__name__+"("+repr(list(self))+")"
+
+  class RBKeysView(RBMapView, KeysView):
+    __slots__ = ()
+    def _item(self,node): return node.value.k
+    def index(self,k):
+      """ Position of key `k` in this view """
+      i = self._mapping.index(k)
+      return len(self._mapping)-1-i if self._reverse else i
+
+  class RBValuesView(RBMapView, ValuesView):
+    __slots__ = ()
+    def _item(self,node): return node.value.v
+    def __contains__(self,value):
+      return any(v is value or v == value for v in self)
+
+  class RBItemsView(RBMapView, ItemsView):
+    __slots__ = ()
+    def _item(self,node): return (node.value.k, node.value.v)
+
+  def __init__(self,h=None,key=None,reverse=False,maxlen=None,evict='min',
+               engine=None,hashindex=False,lazy=None,changelog=None):
+    """
+    :key function applied to each map key to get its sort key (see pyRBT)
+    :reverse True to order by descending key
+    :maxlen,evict bound the number of keys held, as in pyRBT
+    :engine 'rbt' or 'bplus', as in pyRBT
+    :hashindex True for O(1) lookup of hashable keys, as in pyRBT
+    :lazy fraction of dead nodes that triggers compaction, as in pyRBT
+    :changelog number of recent changes to log for changes_since()
+    """
+    super(pyRBMap,self).__init__(key=key,reverse=reverse,maxlen=maxlen,
+                                 evict=evict,engine=engine,hashindex=hashindex,
+                                 lazy=lazy,changelog=changelog)
     if h is not None: self.extend(h)
 
   def __cmp__(x,y):
@@ -605,27 +1256,116 @@ class pyRBMap(pyRBT):
     return 0
 
   def insert(self,k,v):
-    return super(pyRBMap,self).insert(pyRBMap.RBKeyValue(k,v)).v
+    sk = k if self.key is None else self.key(k)
+    node = self._insert(sk,pyRBMap.RBKeyValue(k,v))
+    return None if node is None else node.value.v
 
   def extend(self,h):
-    for k,v in h.items():
+    """ Insert all key,value pairs from a mapping or an iterable of pairs """
+    for k,v in (h.items() if hasattr(h,'items') else h):
       self.insert(k,v)
 
+  def update(self,*args,**kwargs):
+    """ Insert pairs from an optional mapping or iterable, then from kwargs """
+    if len(args) > 1:
+      raise TypeError("update expected at most 1 argument, got %d" % len(args))
+    if len(args) == 1: self.extend(args[0])
+    if len(kwargs) > 0: self.extend(kwargs)
+
+  def get(self,k,default=None):
+    """ Return the value for key k if present, otherwise default """
+    node = self.findnode(k)
+    return default if node is None else node.value.v
+
+  def setdefault(self,k,default=None):
+    """ Return the value for key k, inserting default first if k is absent """
+    sk = k if self.key is None else self.key(k)
+    node = self._insert(sk,pyRBMap.RBKeyValue(k,default),replace=False)
+    return default if node is None else node.value.v
+
+  def pop(self,k,default=_NOTSET):
+    """
+    Remove key k and return its value. If k is absent return default, or raise
+    KeyError if no default was given. Use popitem() to remove by position.
+    """
+    node = self.findnode(k)
+    if node is None:
+      if default is _NOTSET: raise KeyError("RBMap key '"+str(k)+"' not found")
+      return default
+    return self._delete_node(node).v
+
+  def popitem(self,i=-1):
+    """ Remove and return the (key,value) pair at index i (default last) """
+    if len(self) == 0: raise KeyError("popitem(): map is empty")
+    return self.pop_at(i)
+
+  def peekitem(self,i=-1):
+    """ Return the (key,value) pair at index i (default last) """
+    return self.item_at(i)
+
+  def item_at(self,i):
+    """ The (key,value) pair at index i in map order, in O(log N) """
+    x = self.getnode(i).value
+    return (x.k, x.v)
+
+  def key_at(self,i):
+    """ The key at index i in map order, in O(log N) """
+    return self.getnode(i).value.k
+
+  def pop_at(self,i):
+    """ Remove and return the (key,value) pair at index i, in O(log N) """
+    x = self._delete_node(self.getnode(i))
+    return (x.k, x.v)
+
+  def items_between_ranks(self,i,j):
+    """
+    Generator for the (key,value) pairs at indices i..j-1 in map order, as
+    for m[i:j]. One O(log N) descent, then walks successors.
+    """
+    i,j,_ = slice(i,j).indices(len(self))
+    for node in self._nodes_between_ranks(i,j):
+      yield (node.value.k, node.value.v)
+
+  def floor_key(self,k):
+    """ Return the last key at or before k in map order, or None """
+    node = self._floornode(k)
+    return None if node is None else node.value.k
+
+  def ceiling_key(self,k):
+    """ Return the first key at or after k in map order, or None """
+    node = self._ceilingnode(k)
+    return None if node is None else node.value.k
+
+  def irange_items(self,lo=None,hi=None,inclusive=(True,True),reverse=False):
+    """ Generator for (key,value) pairs with keys between lo and hi """
+    for node in self._irange_nodes(lo,hi,inclusive,reverse):
+      yield (node.value.k, node.value.v)
+
   def remove(self,item):
-    return super(pyRBMap,self).remove(pyRBMap.RBKeyValue(item)).v
+    return super(pyRBMap,self).remove(item).v
+
+  def _change(self,op,item):
+    if item is None: return (op,None,None)
+    return (op,item.k,None if op == 'del' else item.v)
+
+  def _change_item(self,k,v):
+    return pyRBMap.RBKeyValue(k,v)
 
   def __setitem__(self,k,v):
     self.insert(k,v)
 
   def __getitem__(self,key):
+    """
+    m[k] is the value for key k. m[i:j] is a list of the (key,value) pairs at
+    indices i..j-1.
+    """
     if isinstance(key, slice):
-      return [ self.find(pyRBMap.RBKeyValue(x)).v for x in range(*key.indices(len(self))) ]
-    if isinstance(key, int):
-      return self.find(pyRBMap.RBKeyValue(key)).v
-    raise TypeError("Invalid argument type.")
-
-  def __contains__(self,item):
-    return self.find(pyRBMap.RBKeyValue(item)) is not None
+      if key.step is None or key.step == 1:
+        return list(self.items_between_ranks(key.start,key.stop))
+      return [ self.item_at(i) for i in range(*key.indices(len(self))) ]
+    node = self.findnode(key)
+    if node is None: raise KeyError("RBMap key '"+str(key)+"' not found")
+    return node.value.v
 
   def __delitem__(self,k):
     """
@@ -635,14 +1375,16 @@ class pyRBMap(pyRBT):
     self.remove(k)
 
   def keys(self,reverse=False):
-    """ Generator for keys (ordered by key) """
-    for k,v in self:
-      yield k
+    """ View of the keys (ordered by key) """
+    return pyRBMap.RBKeysView(self,reverse)
 
   def values(self,reverse=False):
-    """ Generator for values (ordered by key) """
-    for k,v in self:
-      yield v
+    """ View of the values (ordered by key) """
+    return pyRBMap.RBValuesView(self,reverse)
+
+  def items(self,reverse=False):
+    """ View of the (key,value) pairs (ordered by key) """
+    return pyRBMap.RBItemsView(self,reverse)
 
   def keyvalues(self,reversed=False):
     """ Generator for (key,value) pairs """
@@ -650,3 +1392,858 @@ class pyRBMap(pyRBT):
 
   def __iter__(self): return pyRBMap.RBMapIterator(self)
   def __reversed__(self): return pyRBMap.RBMapIterator(self,True)
+
+class pyBPT(pyRBT):
+  """
+  B+ tree with the same API as pyRBT, created with pyRBT(...,engine='bplus').
+  Leaves hold sorted Python lists searched with bisect and internal nodes hold
+  the max key and size of each child, so there are far fewer objects and
+  interpreted steps per operation than with one node per value.
+  Values are stored in ascending key order; positions are mirrored when
+  reverse=True. Nodes returned by findnode(), getnode() etc. are handles that
+  are only valid until the tree is next edited.
+  """
+  __slots__ = ()
+  leafsize = 512 # split leaves holding more values than this
+  fanout = 64 # split internal nodes with more children than this
+  _sharekeys = True # leaves use one list for keys and values when key is None
+
+  class BPLeaf(object):
+    __slots__ = ('keys','values','parent','prev','next')
+    def __init__(self,keys,values):
+      self.keys = keys
+      self.values = values
+      self.parent = self.prev = self.next = None
+    @property
+    def size(self): return len(self.keys)
+    @property
+    def maxkey(self): return self.keys[-1]
+    def treestr(self):
+      return "("+",".join([str(v) for v in self.values])+")"
+
+  class BPInner(object):
+    __slots__ = ('children','maxes','sizes','size','parent')
+    def __init__(self,children,maxes,sizes):
+      self.children = children
+      self.maxes = maxes
+      self.sizes = sizes
+      self.size = sum(sizes)
+      self.parent = None
+      for c in children: c.parent = self
+    @property
+    def maxkey(self): return self.maxes[-1]
+    def treestr(self):
+      return "["+",".join([c.treestr() for c in self.children])+"]"
+
+  class BPNode(object):
+    """ Handle on the i-th value of a leaf """
+    __slots__ = ('leaf','i')
+    def __init__(self,leaf,i): self.leaf,self.i = leaf,i
+    @property
+    def value(self): return self.leaf.values[self.i]
+    @value.setter
+    def value(self,v): self.leaf.values[self.i] = v
+    @property
+    def key(self): return self.leaf.keys[self.i]
+
+  class BPTIterator(object):
+    """
+    Iterator over values in order. Supports deletion of the current value.
+    """
+    __slots__ = ('tree','fwd','leaf','i','cur')
+    def __init__(self,tree,reverse=False):
+      self.tree = tree
+      # fwd is the direction of iteration through the ascending leaves
+      self.fwd = bool(tree.reverse) == bool(reverse)
+      self.cur = None # (leaf,i) of the last value returned
+      n = len(tree)
+      self.leaf,self.i = (None,0) if n == 0 else tree._bp_at(0 if self.fwd else n-1)
+    def __iter__(self): return self
+    def _item(self,leaf,i): return leaf.values[i]
+    def _goto(self,pos):
+      """ Continue iterating from ascending position pos """
+      if 0 <= pos < len(self.tree): self.leaf,self.i = self.tree._bp_at(pos)
+      else: self.leaf = None
+    def next(self): return self.__next__()
+    def __next__(self):
+      leaf,i = self.leaf,self.i
+      if leaf is None: raise StopIteration()
+      self.cur = (leaf,i)
+      if self.fwd:
+        if i+1 < len(leaf.keys): self.i = i+1
+        else: self.leaf,self.i = leaf.next,0
+      elif i > 0: self.i = i-1
+      else:
+        self.leaf = leaf.prev
+        if leaf.prev is not None: self.i = len(leaf.prev.keys)-1
+      return self._item(leaf,i)
+    def prev(self): return self.__prev__()
+    def __prev__(self):
+      if self.cur is None: raise StopIteration()
+      pos = pyBPT._bp_pos(*self.cur)
+      p = pos-1 if self.fwd else pos+1
+      self._goto(pos)
+      self.cur = None
+      if p < 0 or p >= len(self.tree): return None
+      return self._item(*self.tree._bp_at(p))
+    def delete(self):
+      pos = pyBPT._bp_pos(*self.cur)
+      self.tree._bp_delete_at(*self.cur)
+      self.cur = None
+      self._goto(pos if self.fwd else pos-1)
+    def insert(self,v):
+      return self.tree.insert(v)
+
+  def __init__(self,lst=None,key=None,reverse=False,maxlen=None,evict='min',
+               engine=None,hashindex=False,lazy=None,changelog=None):
+    super(pyBPT,self).__init__(None,key,reverse,maxlen,evict,engine,hashindex,
+                               lazy,changelog)
+    self.root = self._bp_newleaf()
+    if lst is not None: self.extend(lst)
+
+  def _bp_newleaf(self):
+    keys = []
+    return pyBPT.BPLeaf(keys, keys if self._sharekeys and self.key is None else [])
+
+  def __iter__(self): return pyBPT.BPTIterator(self)
+  def __reversed__(self): return pyBPT.BPTIterator(self,True)
+
+  def nodes(self,reverse=False):
+    """ Iterator that returns a handle on each value in order """
+    return self._bp_walk(0,len(self)-1,bool(self.reverse) == bool(reverse))
+
+  def __str__(self):
+    return self.root.treestr()
+
+  def clear(self):
+    """ Reset the tree to an empty tree. """
+    self.root = self._bp_newleaf()
+    self._bound = None
+    if self._changes is not None: self._logchange('clear',None)
+
+  def _bp_locate(self,k,right=False):
+    """
+    Descend to the leaf holding the first key >= k (> k if `right`).
+    Returns (leaf,i) where i is the position within the leaf.
+    """
+    node = self.root
+    Inner = pyBPT.BPInner
+    bis = bisect_right if right else bisect_left
+    while type(node) is Inner:
+      j = bis(node.maxes,k)
+      if j == len(node.maxes): j -= 1
+      node = node.children[j]
+    return node,bis(node.keys,k)
+
+  def _bp_bisect(self,k,right=False):
+    """ Ascending position of the first key >= k (> k if `right`) """
+    return pyBPT._bp_pos(*self._bp_locate(k,right))
+
+  @staticmethod
+  def _bp_pos(leaf,i):
+    """ Ascending position of the i-th value in `leaf` """
+    node = leaf
+    while node.parent is not None:
+      pa = node.parent
+      j = pa.children.index(node)
+      if j > 0: i += sum(pa.sizes[:j])
+      node = pa
+    return i
+
+  def _bp_at(self,pos):
+    """ Returns (leaf,i) holding ascending position pos, which must exist """
+    node = self.root
+    Inner = pyBPT.BPInner
+    while type(node) is Inner:
+      sizes = node.sizes
+      j = 0
+      while pos >= sizes[j]:
+        pos -= sizes[j]
+        j += 1
+      node = node.children[j]
+    return node,pos
+
+  def _bp_end(self,last):
+    """ Returns (leaf,i) of the smallest key, or the largest if `last` """
+    node = self.root
+    Inner = pyBPT.BPInner
+    while type(node) is Inner: node = node.children[-1 if last else 0]
+    return node,(len(node.keys)-1 if last else 0)
+
+  def _bp_walk(self,a,b,fwd=True):
+    """ Generator of handles for ascending positions a..b, walking the leaves """
+    if a > b: return
+    leaf,i = self._bp_at(a if fwd else b)
+    for _ in range(b-a+1):
+      yield pyBPT.BPNode(leaf,i)
+      if fwd:
+        i += 1
+        if i == len(leaf.keys): leaf,i = leaf.next,0
+      else:
+        i -= 1
+        if i < 0:
+          leaf = leaf.prev
+          if leaf is not None: i = len(leaf.keys)-1
+
+  def _bp_insert_at(self,leaf,i,k,item):
+    """ Insert at position i of leaf, then update sizes and split if needed """
+    keys = leaf.keys
+    keys.insert(i,k)
+    if leaf.values is not keys: leaf.values.insert(i,item)
+    newmax = (i == len(keys)-1)
+    node = leaf
+    while node.parent is not None:
+      pa = node.parent
+      j = pa.children.index(node)
+      pa.sizes[j] += 1
+      pa.size += 1
+      if newmax:
+        pa.maxes[j] = k
+        newmax = (j == len(pa.children)-1)
+      node = pa
+    if len(keys) > self.leafsize: self._bp_split(leaf)
+
+  def _bp_delete_at(self,leaf,i):
+    """ Delete position i of leaf, then update sizes and merge if needed """
+    keys = leaf.keys
+    value = leaf.values[i]
+    if self._changes is not None: self._logchange('del',value)
+    del keys[i]
+    if leaf.values is not keys: del leaf.values[i]
+    newmax = (i == len(keys) and i > 0)
+    node = leaf
+    while node.parent is not None:
+      pa = node.parent
+      j = pa.children.index(node)
+      pa.sizes[j] -= 1
+      pa.size -= 1
+      if newmax:
+        pa.maxes[j] = keys[-1]
+        newmax = (j == len(pa.children)-1)
+      node = pa
+    if leaf.parent is not None and len(keys) < max(1,self.leafsize//4):
+      self._bp_merge(leaf)
+    return value
+
+  def _bp_split(self,node):
+    """ Split an overfull node in two, adding the new half to its parent """
+    mid = node.size//2 if type(node) is pyBPT.BPLeaf else len(node.children)//2
+    if type(node) is pyBPT.BPLeaf:
+      keys = node.keys
+      nkeys = keys[mid:]
+      del keys[mid:]
+      if node.values is keys: nvals = nkeys
+      else:
+        nvals = node.values[mid:]
+        del node.values[mid:]
+      new = pyBPT.BPLeaf(nkeys,nvals)
+      new.prev,new.next = node,node.next
+      if node.next is not None: node.next.prev = new
+      node.next = new
+    else:
+      new = pyBPT.BPInner(node.children[mid:],node.maxes[mid:],node.sizes[mid:])
+      del node.children[mid:], node.maxes[mid:], node.sizes[mid:]
+      node.size -= new.size
+    pa = node.parent
+    if pa is None:
+      self.root = pyBPT.BPInner([node,new],[node.maxkey,new.maxkey],
+                                [node.size,new.size])
+      return
+    j = pa.children.index(node)
+    pa.children.insert(j+1,new)
+    pa.maxes.insert(j+1,new.maxkey)
+    pa.sizes.insert(j+1,new.size)
+    pa.maxes[j],pa.sizes[j] = node.maxkey,node.size
+    new.parent = pa
+    if len(pa.children) > self.fanout: self._bp_split(pa)
+
+  def _bp_merge(self,node):
+    """ Merge an underfull node with a sibling, splitting again if too large """
+    pa = node.parent
+    j = pa.children.index(node)
+    if j+1 == len(pa.children): j -= 1
+    left,right = pa.children[j],pa.children[j+1]
+    if type(left) is pyBPT.BPLeaf:
+      left.keys.extend(right.keys)
+      if left.values is not left.keys: left.values.extend(right.values)
+      left.next = right.next
+      if right.next is not None: right.next.prev = left
+      overfull = len(left.keys) > self.leafsize
+    else:
+      left.children.extend(right.children)
+      left.maxes.extend(right.maxes)
+      left.sizes.extend(right.sizes)
+      left.size += right.size
+      for c in right.children: c.parent = left
+      overfull = len(left.children) > self.fanout
+    del pa.children[j+1], pa.maxes[j+1], pa.sizes[j+1]
+    pa.sizes[j] = left.size
+    pyBPT._bp_fixmax(left) # `node` may have been emptied, losing its max
+    if overfull: self._bp_split(left)
+    elif pa.parent is None:
+      if len(pa.children) == 1:
+        self.root = left
+        left.parent = None
+    elif len(pa.children) < max(2,self.fanout//4):
+      self._bp_merge(pa)
+
+  @staticmethod
+  def _bp_fixmax(node):
+    """ Propagate the max key of `node` up to its ancestors """
+    while node.parent is not None:
+      pa = node.parent
+      j = pa.children.index(node)
+      pa.maxes[j] = node.maxkey
+      if j+1 < len(pa.children): break
+      node = pa
+
+  def _insert(self,k,item,multiset=False,replace=True):
+    """
+    Add `item` with precomputed sort key `k` into the tree.
+    Returns a handle on `item`, or None if rejected by a full bounded tree.
+    """
+    evict = None
+    if self.maxlen is not None and len(self) >= self.maxlen:
+      if self.maxlen == 0: return None
+      # the boundary is at one end of the ascending leaves
+      evict = self._bp_end(self.evict == 'max')
+      bk = evict[0].keys[evict[1]]
+      if multiset and k == bk: return None
+      if (k < bk) if self.evict == 'min' else (bk < k): return None
+    # multiset values go after equal keys in tree order
+    right = multiset and not self.reverse
+    leaf,i = self._bp_locate(k,right)
+    if not multiset and i < len(leaf.keys) and leaf.keys[i] == k:
+      if replace:
+        leaf.keys[i],leaf.values[i] = k,item
+        if self._changes is not None: self._logchange('set',item)
+      return pyBPT.BPNode(leaf,i)
+    if evict is not None:
+      self._bp_delete_at(*evict)
+      leaf,i = self._bp_locate(k,right)
+    self._bp_insert_at(leaf,i,k,item)
+    if self._changes is not None: self._logchange('set',item)
+    if i >= len(leaf.keys): leaf,i = leaf.next,i-len(leaf.keys)
+    return pyBPT.BPNode(leaf,i)
+
+  def _delete_node(self,node):
+    return self._bp_delete_at(node.leaf,node.i)
+
+  def findnode(self,item,node=None):
+    """ Find a handle on a given value. Returns None if not found. """
+    if node is not None: raise ValueError("pyBPT.findnode does not take a node")
+    k = item if self.key is None else self.key(item)
+    leaf,i = self._bp_locate(k)
+    if i < len(leaf.keys) and leaf.keys[i] == k: return pyBPT.BPNode(leaf,i)
+    return None
+
+  def getnode(self,i,start=None):
+    """ Find a handle on the i-th item. """
+    if start is not None: raise ValueError("pyBPT.getnode does not take a start")
+    n = len(self)
+    if i < 0: i += n # allow negative indices
+    if i < 0 or i >= n:
+      raise IndexError("index out of range (%d vs 0..%d)" % (i, n))
+    leaf,j = self._bp_at(n-1-i if self.reverse else i)
+    return pyBPT.BPNode(leaf,j)
+
+  def index(self,item,start=None):
+    """ Get the first index of an given value """
+    if start is not None: raise ValueError("pyBPT.index does not take a start")
+    k = item if self.key is None else self.key(item)
+    if not self.reverse:
+      leaf,i = self._bp_locate(k)
+      if i < len(leaf.keys) and leaf.keys[i] == k: return pyBPT._bp_pos(leaf,i)
+    else:
+      # first in reverse order is the last equal key in ascending order
+      leaf,i = self._bp_locate(k,True)
+      if i == 0: leaf = leaf.prev
+      if leaf is not None:
+        i = (i or len(leaf.keys))-1
+        if leaf.keys[i] == k: return len(self)-1-pyBPT._bp_pos(leaf,i)
+    raise KeyError('Key not found: '+str(item))
+
+  def rank(self,item):
+    node = self._ceilingnode(item)
+    if node is None: return len(self)
+    pos = pyBPT._bp_pos(node.leaf,node.i)
+    return len(self)-1-pos if self.reverse else pos
+
+  def _nodes_between_ranks(self,i,j):
+    if not self.reverse: return self._bp_walk(i,j-1,True)
+    n = len(self)
+    return self._bp_walk(n-j,n-1-i,False)
+
+  def compact(self):
+    """ Removals from a B+ tree are never lazy, so there is nothing to do """
+    pass
+
+  def _bp_handle(self,pos):
+    if pos < 0 or pos >= len(self): return None
+    return pyBPT.BPNode(*self._bp_at(pos))
+
+  def _floornode(self,item,inclusive=True):
+    k = item if self.key is None else self.key(item)
+    if self.reverse: return self._bp_handle(self._bp_bisect(k,not inclusive))
+    return self._bp_handle(self._bp_bisect(k,inclusive)-1)
+
+  def _ceilingnode(self,item,inclusive=True):
+    k = item if self.key is None else self.key(item)
+    if self.reverse: return self._bp_handle(self._bp_bisect(k,inclusive)-1)
+    return self._bp_handle(self._bp_bisect(k,not inclusive))
+
+  def _irange_nodes(self,lo=None,hi=None,inclusive=(True,True),reverse=False):
+    # ascending bounds: [lo,hi] normally, [hi,lo] when the tree is reversed
+    (a,ainc),(b,binc) = (hi,inclusive[1]),(lo,inclusive[0])
+    if not self.reverse: (a,ainc),(b,binc) = (b,binc),(a,ainc)
+    key = (lambda x: x) if self.key is None else self.key
+    start = 0 if a is None else self._bp_bisect(key(a),not ainc)
+    end = len(self)-1 if b is None else self._bp_bisect(key(b),binc)-1
+    return self._bp_walk(start,end,bool(self.reverse) == bool(reverse))
+
+  @staticmethod
+  def _bp_chunks(n,size):
+    """ Split range(n) into near-equal (lo,hi) chunks of at most `size` """
+    m = (n+size-1)//size
+    return [ (i*n//m,(i+1)*n//m) for i in range(m) ]
+
+  def _bulk_load(self,keys,items):
+    """
+    Replace the contents of the tree with `items`, which must already be in
+    tree order, with sort keys `keys`. Builds leaves 3/4 full in O(N).
+    """
+    if len(items) == 0: return self.clear()
+    if self.reverse: keys,items = keys[::-1],items[::-1]
+    share = self._sharekeys and self.key is None
+    nodes,prev = [],None
+    for (lo,hi) in pyBPT._bp_chunks(len(items),max(1,self.leafsize*3//4)):
+      ks = keys[lo:hi]
+      leaf = pyBPT.BPLeaf(ks, ks if share else items[lo:hi])
+      leaf.prev = prev
+      if prev is not None: prev.next = leaf
+      nodes.append(leaf)
+      prev = leaf
+    while len(nodes) > 1:
+      nodes = [ pyBPT.BPInner(nodes[lo:hi],[c.maxkey for c in nodes[lo:hi]],
+                                          [c.size for c in nodes[lo:hi]])
+                for (lo,hi) in pyBPT._bp_chunks(len(nodes),max(3,self.fanout*3//4)) ]
+    self.root = nodes[0]
+    self.root.parent = None
+    self._bound = None
+    if self._changes is not None:
+      self._logload(items[::-1] if self.reverse else items)
+
+  def _split(self,pred):
+    """
+    Split off the values whose keys satisfy pred, which must hold for a prefix
+    of the tree. Returns them as a new tree, leaving the rest in this tree.
+    Rebuilds both trees in O(N).
+    """
+    nodes = list(self.nodes())
+    keys,items = [ x.key for x in nodes ],[ x.value for x in nodes ]
+    m = 0
+    while m < len(keys) and pred(keys[m]): m += 1
+    left = self._empty_like()
+    left._bulk_load(keys[:m],items[:m])
+    log,self._changes = self._changes,None
+    self._bulk_load(keys[m:],items[m:])
+    self._changes = log
+    if log is not None:
+      for item in items[:m]: self._logchange('del',item)
+    return left
+
+  def check(self):
+    """ Check data structure integrity by checking invariants are met. """
+    Inner = pyBPT.BPInner
+    assert self.root.parent is None
+    leaves,depths = [],set()
+    stack = [(self.root,0)]
+    while len(stack) > 0:
+      node,depth = stack.pop()
+      if type(node) is Inner:
+        n = len(node.children)
+        assert n == len(node.maxes) == len(node.sizes) and 2 <= n <= self.fanout
+        assert node.size == sum(node.sizes)
+        for (c,m,s) in zip(node.children,node.maxes,node.sizes):
+          assert c.parent is node and c.size == s and c.maxkey == m
+        stack.extend([ (c,depth+1) for c in reversed(node.children) ])
+      else:
+        assert len(node.keys) == len(node.values) <= self.leafsize
+        assert node.parent is None or len(node.keys) > 0
+        assert (node.values is node.keys) == (self._sharekeys and self.key is None)
+        leaves.append(node)
+        depths.add(depth)
+    assert len(depths) == 1 # all leaves at the same depth
+    assert leaves[0].prev is None and leaves[-1].next is None
+    for (a,b) in zip(leaves,leaves[1:]): assert a.next is b and b.prev is a
+    keys = [ k for leaf in leaves for k in leaf.keys ]
+    assert all([ not (b < a) for (a,b) in zip(keys,keys[1:]) ])
+    assert len(keys) == len(self)
+    assert self.maxlen is None or len(self) <= self.maxlen
+
+class pyBPMap(pyRBMap,pyBPT):
+  """ pyRBMap API on the B+ tree engine, see pyBPT """
+  _sharekeys = False
+
+  class BPMapIterator(pyBPT.BPTIterator):
+    __slots__ = ()
+    def _item(self,leaf,i):
+      x = leaf.values[i]
+      return (x.k, x.v)
+    def insert(self,k,v):
+      return self.tree.insert(k,v)
+
+  def keyvalues(self,reversed=False):
+    """ Generator for (key,value) pairs """
+    return pyBPMap.BPMapIterator(self,reversed)
+
+  def __iter__(self): return pyBPMap.BPMapIterator(self)
+  def __reversed__(self): return pyBPMap.BPMapIterator(self,True)
+
+class pyRBJournal(object):
+  """
+  Durable wrapper around a pyRBT or pyRBMap (of either engine). Each edit made
+  through the wrapper is appended to a journal file at `path` as a compact
+  binary record. Records are written `batch` at a time (group commit) and
+  fsync'd when `fsync` is True. snapshot() writes the contents in order to
+  `path`+'.snap' and starts an empty journal; this happens automatically once
+  `snapshot_every` records have been journaled.
+
+  Opening an existing journal recovers the tree: the snapshot is bulk loaded in
+  O(N) and the records journaled after it are replayed. A torn record at the
+  end of the journal (from a crash mid-write) is discarded. `tree` must be
+  constructed with the same options (key, reverse, maxlen...) each time. When
+  there is no journal or snapshot yet, the contents of `tree` are kept and
+  written as the first snapshot.
+
+  An edit whose arguments cannot be pickled is refused before it changes the
+  tree. An edit that raises is still journaled, so replay repeats any partial
+  change it made.
+
+  Read from the tree directly with `journal.tree`; edit through the journal.
+  """
+  _JMAGIC = b'PYRBTJ1\n'
+  _SMAGIC = b'PYRBTS1\n'
+  _GEN = struct.Struct('<Q') # generation of a snapshot and its journal
+  _RECORD = struct.Struct('<BII') # op, payload length, crc32 of payload
+  _OPS = ('insert','extend','remove','pop','clear','__setitem__','__delitem__',
+          'setdefault','popitem')
+  _FAILED = 0x80 # op flag: the edit raised when made, and raises on replay
+  _CHUNK = 1024 # values per pickle in a snapshot
+
+  def __init__(self,path,tree=None,batch=1,fsync=True,snapshot_every=None):
+    self.path = path
+    self.tree = pyRBT() if tree is None else tree
+    self.batch = batch
+    self.fsync = fsync
+    self.snapshot_every = snapshot_every
+    self._pending = [] # encoded records waiting for the next group commit
+    self._nrecords = 0 # records in the journal since the last snapshot
+    fresh = not os.path.exists(path) and not os.path.exists(path+'.snap')
+    self._gen = 0 if fresh else self._load_snapshot()
+    self._file = self._replay()
+    if fresh and len(self.tree) > 0: self.snapshot()
+
+  def __len__(self): return len(self.tree)
+  def __iter__(self): return iter(self.tree)
+  def __contains__(self,item): return item in self.tree
+  def __getitem__(self,key): return self.tree[key]
+  def __enter__(self): return self
+  def __exit__(self,*args): self.close()
+
+  def _checkopen(self):
+    if self._file is None: raise ValueError("pyRBJournal is closed")
+
+  # Arguments are pickled before the tree is touched, so an edit that cannot
+  # be journaled is not made
+  def _apply(self,op,*args):
+    self._checkopen()
+    payload = pickle.dumps(args,pickle.HIGHEST_PROTOCOL)
+    code = self._OPS.index(op)
+    try: ret = getattr(self.tree,op)(*args)
+    except Exception:
+      # it may have changed the tree part way (e.g. extend), so journal it to
+      # make the same partial change on replay
+      self._record(code | self._FAILED,payload)
+      raise
+    self._record(code,payload)
+    return ret
+
+  def _record(self,code,payload):
+    crc = zlib.crc32(payload) & 0xffffffff
+    self._pending.append(self._RECORD.pack(code,len(payload),crc) + payload)
+    if len(self._pending) >= self.batch: self.commit()
+
+  def insert(self,*args): return self._apply('insert',*args)
+  def remove(self,item): return self._apply('remove',item)
+  def pop(self,*args): return self._apply('pop',*args)
+  def clear(self): return self._apply('clear')
+  def setdefault(self,*args): return self._apply('setdefault',*args)
+  def popitem(self,*args): return self._apply('popitem',*args)
+  def __setitem__(self,k,v): self._apply('__setitem__',k,v)
+  def __delitem__(self,k): self._apply('__delitem__',k)
+
+  def extend(self,items,*args):
+    """ Insert all items (or key,value pairs into a map) as one record """
+    items = list(items.items()) if hasattr(items,'items') else list(items)
+    return self._apply('extend',items,*args)
+
+  def update(self,*args,**kwargs):
+    """ pyRBMap.update(), journaled as one record """
+    pairs = []
+    for h in args + (kwargs,):
+      pairs.extend(h.items() if hasattr(h,'items') else h)
+    self.extend(pairs)
+
+  def _flush(self):
+    """ Write out pending records """
+    if len(self._pending) > 0:
+      self._file.write(b''.join(self._pending))
+      self._nrecords += len(self._pending)
+      self._pending = []
+      self._file.flush()
+      if self.fsync: os.fsync(self._file.fileno())
+
+  def commit(self):
+    """ Write and sync pending records, taking a snapshot if one is due """
+    self._checkopen()
+    self._flush()
+    if self.snapshot_every is not None and self._nrecords >= self.snapshot_every:
+      self.snapshot()
+
+  def close(self):
+    """ Commit pending records and close the journal """
+    if self._file is not None:
+      self._flush()
+      self._file.close()
+      self._file = None
+
+  def snapshot(self):
+    """
+    Write the tree contents in order to the snapshot file, then start a new
+    empty journal. Both files are replaced atomically by renaming.
+    """
+    self._checkopen()
+    self._flush()
+    gen = self._gen+1
+    ismap = isinstance(self.tree,pyRBMap)
+    tmp = self.path+'.snap.tmp'
+    with open(tmp,'wb') as f:
+      f.write(self._SMAGIC + self._GEN.pack(gen) + self._GEN.pack(len(self.tree)))
+      chunk = []
+      for node in self.tree.nodes():
+        chunk.append((node.value.k,node.value.v) if ismap else node.value)
+        if len(chunk) == self._CHUNK:
+          pickle.dump(chunk,f,pickle.HIGHEST_PROTOCOL)
+          chunk = []
+      if len(chunk) > 0: pickle.dump(chunk,f,pickle.HIGHEST_PROTOCOL)
+      f.flush()
+      if self.fsync: os.fsync(f.fileno())
+    _replace(tmp,self.path+'.snap')
+    if self.fsync: _fsync_dir(self.path)
+    # a crash here leaves the old journal, which is ignored as it has the
+    # previous generation
+    self._file.close()
+    self._file = self._new_journal(gen)
+    self._gen = gen
+    self._nrecords = 0
+
+  def _load_snapshot(self):
+    """ Bulk load the snapshot into the tree, returning its generation """
+    tree = self.tree
+    tree.clear()
+    if not os.path.exists(self.path+'.snap'): return 0
+    with open(self.path+'.snap','rb') as f:
+      head = f.read(len(self._SMAGIC) + 2*self._GEN.size)
+      if head[:len(self._SMAGIC)] != self._SMAGIC:
+        raise ValueError("Not a pyRBT snapshot: "+self.path+'.snap')
+      gen, = self._GEN.unpack_from(head,len(self._SMAGIC))
+      n, = self._GEN.unpack_from(head,len(self._SMAGIC)+self._GEN.size)
+      values = []
+      while len(values) < n: values.extend(pickle.load(f))
+    key = (lambda x: x) if tree.key is None else tree.key
+    if isinstance(tree,pyRBMap):
+      tree._bulk_load([ key(k) for (k,v) in values ],
+                      [ pyRBMap.RBKeyValue(k,v) for (k,v) in values ])
+    else:
+      tree._bulk_load(values if tree.key is None else [ key(v) for v in values ],
+                      values)
+    return gen
+
+  def _replay(self):
+    """
+    Replay the journal written after the snapshot, truncate any torn record
+    at its end and return it open for appending.
+    """
+    head = self._JMAGIC + self._GEN.pack(self._gen)
+    if not os.path.exists(self.path): return self._new_journal(self._gen)
+    f = open(self.path,'r+b')
+    if f.read(len(head)) != head:
+      # stale (older generation) or incomplete journal: start a new one
+      f.close()
+      return self._new_journal(self._gen)
+    end = len(head)
+    while True:
+      rec = f.read(self._RECORD.size)
+      if len(rec) < self._RECORD.size: break
+      code,length,crc = self._RECORD.unpack(rec)
+      op = code & ~self._FAILED
+      payload = f.read(length)
+      if (len(payload) < length or op >= len(self._OPS) or
+          zlib.crc32(payload) & 0xffffffff != crc): break
+      try: getattr(self.tree,self._OPS[op])(*pickle.loads(payload))
+      except Exception:
+        if not code & self._FAILED: raise
+      self._nrecords += 1
+      end = f.tell()
+    f.seek(end)
+    f.truncate()
+    return f
+
+  def _new_journal(self,gen):
+    """ Atomically replace the journal with an empty one of generation gen """
+    tmp = self.path+'.tmp'
+    with open(tmp,'wb') as f:
+      f.write(self._JMAGIC + self._GEN.pack(gen))
+      f.flush()
+      if self.fsync: os.fsync(f.fileno())
+    _replace(tmp,self.path)
+    if self.fsync: _fsync_dir(self.path)
+    return open(self.path,'ab')
+
+class pyRBTTLMap(object):
+  """
+  Ordered map whose entries expire. Entries live in a pyRBMap (in `engine`)
+  and entries with a deadline are also kept in a second tree ordered by
+  (deadline, key), so expire() splits off every expired entry at once instead
+  of removing them one at a time. Expired entries read as missing.
+
+  :ttl default time-to-live in seconds for set() (None: never expire)
+  :maxlen,maxbytes bound the number of entries and their total size, evicting
+                   expired then least recently used entries when exceeded
+  :sizeof function (key,value) -> bytes, sys.getsizeof of both by default
+  :clock function returning the current time, time.time by default
+  Keys must be orderable and hashable, as the LRU order is kept in an
+  OrderedDict. len() counts entries not yet swept by expire().
+  """
+  def __init__(self,ttl=None,maxlen=None,maxbytes=None,sizeof=None,
+               clock=time.time,engine='rbt'):
+    self.ttl = ttl
+    self.maxlen = maxlen
+    self.maxbytes = maxbytes
+    self.sizeof = sizeof or (lambda k,v: sys.getsizeof(k) + sys.getsizeof(v))
+    self.clock = clock
+    self.map = pyRBMap(engine=engine) # key -> (value,deadline,nbytes)
+    self.deadlines = pyRBT() # (deadline,key) of entries that expire
+    self.nbytes = 0
+    self._lru = OrderedDict() # keys, least recently used first
+
+  def __len__(self): return len(self.map)
+
+  def _touch(self,k):
+    self._lru.pop(k,None)
+    self._lru[k] = None
+
+  def _drop(self,k):
+    """ Remove key k, which must be present, returning its value """
+    (v,deadline,nbytes) = self.map.pop(k)
+    if deadline is not None: self.deadlines.remove((deadline,k))
+    del self._lru[k]
+    self.nbytes -= nbytes
+    return v
+
+  def set(self,k,v,ttl=_NOTSET,now=None):
+    """ Set k to v, expiring `ttl` seconds after `now` (default: self.ttl) """
+    if ttl is _NOTSET: ttl = self.ttl
+    if now is None: now = self.clock()
+    if k in self.map: self._drop(k)
+    deadline = None if ttl is None else now + ttl
+    nbytes = self.sizeof(k,v)
+    self.map[k] = (v,deadline,nbytes)
+    if deadline is not None: self.deadlines.insert((deadline,k))
+    self.nbytes += nbytes
+    self._touch(k)
+    if ((self.maxlen is not None and len(self.map) > self.maxlen) or
+        (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+      self._shrink(now)
+
+  def _shrink(self,now):
+    """ Expire, then evict least recently used entries until within bounds """
+    self.expire(now)
+    while ((self.maxlen is not None and len(self.map) > self.maxlen) or
+           (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+      self._drop(next(iter(self._lru)))
+
+  def get(self,k,default=None,now=None):
+    """ Return the value for k, or default if k is missing or expired """
+    entry = self.map.get(k)
+    if entry is None: return default
+    if entry[1] is not None and entry[1] <= (self.clock() if now is None else now):
+      self._drop(k)
+      return default
+    self._touch(k)
+    return entry[0]
+
+  def __getitem__(self,k):
+    v = self.get(k,_NOTSET)
+    if v is _NOTSET: raise KeyError("TTLMap key '"+str(k)+"' not found")
+    return v
+
+  def __setitem__(self,k,v): self.set(k,v)
+
+  def __contains__(self,k):
+    entry = self.map.get(k)
+    return entry is not None and (entry[1] is None or entry[1] > self.clock())
+
+  def __delitem__(self,k):
+    if k not in self.map: raise KeyError("TTLMap key '"+str(k)+"' not found")
+    self._drop(k)
+
+  def pop(self,k,default=_NOTSET):
+    """ Remove k and return its value, or default if missing or expired """
+    v = self.get(k,_NOTSET)
+    if v is not _NOTSET: return self._drop(k)
+    if default is _NOTSET: raise KeyError("TTLMap key '"+str(k)+"' not found")
+    return default
+
+  def clear(self):
+    self.map.clear()
+    self.deadlines.clear()
+    self._lru.clear()
+    self.nbytes = 0
+
+  def deadline(self,k):
+    """ Return the deadline of k, None if it never expires """
+    return self.map[k][1]
+
+  def expire(self,now=None):
+    """ Remove every entry whose deadline is at or before `now` """
+    if now is None: now = self.clock()
+    expired = self.deadlines._split(lambda dk: dk[0] <= now)
+    for (deadline,k) in expired:
+      (v,deadline,nbytes) = self.map.pop(k)
+      del self._lru[k]
+      self.nbytes -= nbytes
+    return len(expired)
+
+  def items(self,now=None):
+    """ Generator for unexpired (key,value) pairs, ordered by key """
+    if now is None: now = self.clock()
+    for (k,(v,deadline,nbytes)) in self.map.items():
+      if deadline is None or deadline > now: yield (k,v)
+
+  def keys(self,now=None):
+    """ Generator for unexpired keys in order """
+    for (k,v) in self.items(now): yield k
+
+  def __iter__(self): return self.keys()
+
+# os.replace is atomic on all platforms but is not available in Python 2
+_replace = getattr(os,'replace',os.rename)
+
+def _fsync_dir(path):
+  """ Sync the directory holding `path`, making renames into it durable """
+  if os.name != 'posix': return # directories cannot be opened on Windows
+  fd = os.open(os.path.dirname(os.path.abspath(path)),os.O_RDONLY)
+  try: os.fsync(fd)
+  finally: os.close(fd)
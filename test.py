@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # coding=utf-8
 from __future__ import print_function
-from pyrbt import pyRBT,pyRBMap
-import random
+from pyrbt import pyRBT,pyRBMap,pyBPT,pyBPMap,pyRBJournal,pyRBTTLMap
+import os,pickle,random,shutil,tempfile
 
 def _test_rbt_auto(nums):
   tree = pyRBT()
@@ -212,6 +212,607 @@ def _test_map():
   assert list(n.keys()) == [2,4,5] and list(n.values()) == ['daisy','woof','words']
   assert list(m.keys()) == [2,4,5] and list(m.values()) == ['daisy','woof','words']
 
+def _test_map_views():
+  print("Testing map views and navigation...")
+  m = pyRBMap([(k,str(k)) for k in range(0,20,2)]) # 0,2,..,18
+  ks,vs,its = m.keys(),m.values(),m.items()
+  assert ks[0] == 0 and ks[-1] == 18 and ks[3] == 6 and ks[2:5] == [4,6,8]
+  assert vs[1] == '2' and its[2] == (4,'4') and len(ks) == 10
+  assert list(m.keys(reverse=True)) == list(range(18,-1,-2))
+  assert m.keys(True)[0] == 18 and m.keys(True)[-1] == 0
+  assert list(reversed(m.keys(True))) == list(ks)
+  assert list(m.values(True))[0] == '18' and m.items(True)[1] == (16,'16')
+  assert ks.index(8) == 4 and m.keys(True).index(8) == 5
+  assert 4 in ks and 5 not in ks and (4,'4') in its and (4,'x') not in its
+  assert '6' in vs and (ks & set([2,3,4])) == set([2,4])
+  ks2 = m.keys()
+  m[1] = '1' # views are backed by the tree
+  assert ks2[1] == 1 and len(ks2) == 11
+  del(m[1])
+  assert m.get(4) == '4' and m.get(5) is None and m.get(5,'x') == 'x'
+  assert m.setdefault(4,'z') == '4' and m.setdefault(5,'z') == 'z' and m[5] == 'z'
+  assert m.pop(5) == 'z' and m.pop(5,None) is None
+  try: m.pop(5); assert False
+  except KeyError: pass
+  assert m.peekitem() == (18,'18') and m.peekitem(0) == (0,'0')
+  assert m.popitem() == (18,'18') and m.popitem(0) == (0,'0') and len(m) == 8
+  assert m.floor_key(7) == 6 and m.floor_key(6) == 6 and m.floor_key(1) is None
+  assert m.ceiling_key(7) == 8 and m.ceiling_key(8) == 8 and m.ceiling_key(17) is None
+  assert list(m.irange_items(5,10)) == [(6,'6'),(8,'8'),(10,'10')]
+  assert [k for k,v in m.irange_items(6,10,(False,False))] == [8]
+  assert [k for k,v in m.irange_items(hi=7,reverse=True)] == [6,4,2]
+  assert [k for k,v in m.irange_items(lo=12)] == [12,14,16]
+  assert [k for k,v in m.irange_items(12,16,(False,True),True)] == [16,14]
+  m.update([(1,'a')])
+  m.update({3:'b'})
+  assert m[1] == 'a' and m[3] == 'b' and list(m.keys())[:3] == [1,2,3]
+  s = pyRBMap()
+  s.update({'b':1},a=2)
+  assert list(s.items()) == [('a',2),('b',1)]
+  r = pyRBMap({1:'a',2:'b',3:'c'},reverse=True)
+  assert r.floor_key(2.5) == 3 and r.ceiling_key(2.5) == 2
+  assert [k for k,v in r.irange_items(3,1,(False,True))] == [2,1]
+  e = pyRBMap()
+  try: e.popitem(); assert False
+  except KeyError: pass
+
+def _test_bounded():
+  print("Testing bounded trees...")
+  for multiset in [False,True]:
+    nums = [random.randrange(100) for x in range(300)]
+    top,bot = pyRBT(maxlen=10),pyRBT(maxlen=10,evict='max')
+    for i,x in enumerate(nums):
+      top.insert(x,multiset)
+      bot.insert(x,multiset)
+      if i % 50 == 25: top.remove(top[3]); bot.pop(0) # invalidate boundaries
+    top.check()
+    bot.check()
+    assert len(top) == 10 and len(bot) == 10
+  t = pyRBT([5,1,9,3,7],maxlen=3)
+  assert list(t) == [5,7,9]
+  assert t.insert(2) is None and list(t) == [5,7,9] # rejected
+  assert t.insert(6) == 6 and list(t) == [6,7,9]
+  assert t.insert(7) == 7 and list(t) == [6,7,9] # replaced, nothing evicted
+  assert t.insert(6,True) is None and list(t) == [6,7,9] # tie with boundary
+  t = pyRBT(range(10),maxlen=3,evict='max',reverse=True)
+  assert list(t) == [2,1,0]
+  t = pyRBT(range(10),maxlen=0)
+  assert len(t) == 0
+  # top-k against sorted()
+  nums = [random.randrange(1000) for x in range(500)]
+  assert list(pyRBT(nums,maxlen=20)) == sorted(set(nums))[-20:]
+  assert list(pyRBT(nums,maxlen=20,evict='max')) == sorted(set(nums))[:20]
+  nums = [random.random() for x in range(500)]
+  t = pyRBT(nums,maxlen=20,key=lambda x: -x,evict='max')
+  assert list(t) == sorted(nums,reverse=True)[:20]
+  m = pyRBMap(maxlen=2)
+  for k,v in [(3,'c'),(1,'a'),(4,'d'),(2,'b')]: m[k] = v
+  assert list(m.items()) == [(3,'c'),(4,'d')]
+  assert m.setdefault(0,'z') == 'z' and 0 not in m
+  try: pyRBT(evict='left'); assert False
+  except ValueError: pass
+
+class _SmallBPT(pyBPT):
+  leafsize,fanout = 4,4 # exercise splits and merges on small trees
+
+def _test_bplus():
+  print("Testing B+ tree engine against red-black engine...")
+  assert type(pyRBT(engine='bplus')) is pyBPT
+  assert type(pyRBMap(engine='bplus')) is pyBPMap
+  try: pyRBT(engine='avl'); assert False
+  except ValueError: pass
+  for trial in range(20):
+    reverse,multiset = random.random() < 0.5,random.random() < 0.5
+    a,b = pyRBT(reverse=reverse),_SmallBPT(reverse=reverse)
+    for step in range(300):
+      x = random.randrange(100)
+      if random.random() < 0.6: assert a.insert(x,multiset) == b.insert(x,multiset)
+      elif len(a) > 0:
+        i = random.randrange(-len(a),len(a))
+        assert a.pop(i) == b.pop(i)
+      b.check()
+      assert list(a) == list(b) and list(reversed(a)) == list(reversed(b))
+      assert (x in a) == (x in b) and a.find(x) == b.find(x)
+      if x in a: assert a.index(x) == b.index(x)
+      lo,hi = (x+20,x) if reverse else (x,x+20)
+      assert ([n.value for n in a._irange_nodes(lo,hi,(True,False))] ==
+              [n.value for n in b._irange_nodes(lo,hi,(True,False))])
+    # iterator delete
+    ia,ib = iter(a),iter(b)
+    for v in ia:
+      if v % 3 == 0: ia.delete()
+    for v in ib:
+      if v % 3 == 0: ib.delete()
+    b.check()
+    assert list(a) == list(b)
+    for i in range(len(a)): assert a[i] == b[i]
+  t = _SmallBPT(range(10))
+  i = iter(t)
+  assert next(i) == 0 and next(i) == 1 and i.prev() == 0 and next(i) == 1
+  assert list(t.intersect(_SmallBPT(range(5,15)))) == [5,6,7,8,9]
+  assert list(pyRBT(range(30),maxlen=5,engine='bplus')) == list(range(25,30))
+  m = pyRBMap({3:'c',1:'a',2:'b'},reverse=True,engine='bplus')
+  m.check()
+  assert list(m) == [(3,'c'),(2,'b'),(1,'a')] and m[2] == 'b' and 4 not in m
+  assert m.keys()[0] == 3 and m.floor_key(0) == 1 and m.pop(2) == 'b'
+  assert m.setdefault(5,'e') == 'e' and m.popitem() == (1,'a')
+  assert list(m.items(reverse=True)) == [(3,'c'),(5,'e')]
+  assert type(pyBPMap({1:'a'})) is pyBPMap and type(pyBPT()) is pyBPT
+  assert type(pyRBT([2,1],None,False,None,'min','bplus')) is pyBPT
+  a = pyRBMap({1:'a',2:'b',3:'c'},engine='bplus')
+  b = pyRBMap({2:'B',4:'d'},engine='bplus')
+  assert type(a.union(b)) is pyBPMap
+  assert list(a.union(b)) == [(1,'a'),(2,'B'),(3,'c'),(4,'d')]
+  assert list(a.diff(b)) == [(1,'a'),(3,'c')]
+  assert list(a.intersect(b)) == [(2,'b')]
+  assert list(a.symmetric_diff(b)) == [(1,'a'),(3,'c'),(4,'d')]
+  u = pyBPMap.merged(a,b,pyRBMap({0:'z'},engine='bplus'))
+  u.check()
+  assert type(u) is pyBPMap and [k for (k,v) in u] == [0,1,2,3,4]
+  a.compact()
+  assert list(a) == [(1,'a'),(2,'b'),(3,'c')]
+
+def _test_journal():
+  print("Testing journal recovery...")
+  d = tempfile.mkdtemp()
+  try:
+    path = os.path.join(d,'tree.journal')
+    j = pyRBJournal(path,pyRBT())
+    j.extend([5,3,9,1])
+    j.insert(3,True)
+    j.remove(9)
+    j.pop(0)
+    assert list(j) == [3,3,5]
+    j.close()
+    j = pyRBJournal(path,pyRBT(engine='bplus'))
+    assert list(j) == [3,3,5]
+    j.snapshot()
+    j.insert(7)
+    j.close()
+    j = pyRBJournal(path,pyRBT())
+    j.tree.check()
+    assert list(j) == [3,3,5,7]
+    j.close()
+    # maps, group commit and automatic snapshots
+    path = os.path.join(d,'map.journal')
+    j = pyRBJournal(path,pyRBMap(),batch=10,fsync=False,snapshot_every=25)
+    h = {}
+    for i in range(103):
+      k = random.randrange(50)
+      if k in h and random.random() < 0.3:
+        del j[k]
+        del h[k]
+      else: j[k] = h[k] = i
+      if (i+1) % 10 == 0: committed = dict(h)
+    # records 101..103 are pending, recovery loses them (as after a crash)
+    r = pyRBJournal(path,pyRBMap())
+    assert list(r.tree.items()) == sorted(committed.items())
+    r.close()
+    j.commit()
+    r = pyRBJournal(path,pyRBMap())
+    assert list(r.tree.items()) == sorted(h.items())
+    r.update({100:'a'})
+    r.setdefault(101,'b')
+    r.close()
+    j.close()
+    r = pyRBJournal(path,pyRBMap())
+    assert r[100] == 'a' and r[101] == 'b' and len(r) == len(h)+2
+    r.close()
+    # a torn record at the end of the journal is discarded
+    with open(path,'ab') as f: f.write(b'\x05\x10\x00')
+    r = pyRBJournal(path,pyRBMap())
+    assert len(r) == len(h)+2
+    # crash between writing a snapshot and replacing the journal
+    shutil.copy(path,path+'.old')
+    r.snapshot()
+    r.close()
+    shutil.copy(path+'.old',path)
+    r = pyRBJournal(path,pyRBMap())
+    r.tree.check()
+    assert len(r) == len(h)+2
+    r.close()
+    # a new journal keeps the contents of the tree it is given
+    path = os.path.join(d,'new.journal')
+    j = pyRBJournal(path,pyRBMap({1:'a',2:'b'}))
+    assert len(j) == 2
+    j[3] = 'c'
+    j.close()
+    try:
+      j[4] = 'd'
+      assert False
+    except ValueError: pass
+    assert 4 not in j.tree
+    j = pyRBJournal(path,pyRBMap({9:'z'}))
+    assert list(j.tree.items()) == [(1,'a'),(2,'b'),(3,'c')]
+    j.close()
+    # failed edits leave the tree as the journal recovers it
+    path = os.path.join(d,'fail.journal')
+    inv = lambda k: 1.0/k
+    j = pyRBJournal(path,pyRBMap(key=inv))
+    j[1] = 'a'
+    try:
+      j[2] = lambda: 1 # cannot be pickled
+      assert False
+    except (pickle.PicklingError,AttributeError,TypeError): pass
+    try:
+      j.extend([(3,'c'),(0,'z'),(4,'d')]) # raises after inserting 3
+      assert False
+    except ZeroDivisionError: pass
+    try:
+      del j[5]
+      assert False
+    except KeyError: pass
+    j[4] = 'd'
+    items = list(j.tree.items())
+    assert items == [(4,'d'),(3,'c'),(1,'a')]
+    j.close()
+    j = pyRBJournal(path,pyRBMap(key=inv))
+    assert list(j.tree.items()) == items
+    j.close()
+  finally:
+    shutil.rmtree(d)
+
+def _test_split():
+  print("Testing split...")
+  for n in [0,1,2,3,10,100,257]:
+    vals = random.sample(range(4*n+1),n)
+    cut = random.randrange(4*n+2)
+    for t in [pyRBT(vals),_SmallBPT(vals)]:
+      left = t._split(lambda k: k < cut)
+      left.check()
+      t.check()
+      assert list(left) == sorted(v for v in vals if v < cut)
+      assert list(t) == sorted(v for v in vals if v >= cut)
+      t.extend(left)
+      t.check()
+      assert list(t) == sorted(vals)
+
+def _test_ttl_map():
+  print("Testing TTL map...")
+  now = [100.0]
+  m = pyRBTTLMap(ttl=10,clock=lambda: now[0])
+  m['a'] = 1
+  m.set('b',2,ttl=5)
+  m.set('c',3,ttl=None)
+  m.set('d',4,ttl=20)
+  assert m['a'] == 1 and m.deadline('b') == 105 and m.deadline('c') is None
+  now[0] = 105
+  assert m.get('b') is None and 'b' not in m and 'a' in m
+  assert list(m.keys()) == ['a','c','d']
+  assert m.expire(111) == 1 and len(m) == 2 and list(m.deadlines) == [(120,'d')]
+  m.set('d',5,ttl=1)
+  assert m.pop('d') == 5 and m.pop('d',None) is None and len(m.deadlines) == 0
+  # many entries expired in one split
+  m = pyRBTTLMap(clock=lambda: now[0])
+  for i in range(200): m.set(i,str(i),ttl=i % 20)
+  assert m.expire(now[0]+9.5) == 100 and len(m) == 100
+  assert all(int(k) % 20 >= 10 for k in m) and len(m.deadlines) == 100
+  m.deadlines.check()
+  # LRU eviction
+  m = pyRBTTLMap(maxlen=3,clock=lambda: now[0])
+  for k in 'abc': m[k] = k
+  m.get('a')
+  m['d'] = 'd'
+  assert list(m) == ['a','c','d']
+  m.set('e','e',ttl=0) # already expired, so is swept before evicting by LRU
+  assert list(m) == ['a','c','d'] and len(m) == 3
+  m['f'] = 'f'
+  assert list(m) == ['a','d','f']
+  m = pyRBTTLMap(maxbytes=10,sizeof=lambda k,v: len(v))
+  m['x'] = 'aaaa'
+  m['y'] = 'bbbb'
+  m['z'] = 'cccc'
+  assert list(m) == ['y','z'] and m.nbytes == 8
+
+def _test_hashindex():
+  print("Testing hashindex...")
+  for rev in [False,True]:
+    t = pyRBT(hashindex=True,reverse=rev)
+    vals = random.sample(range(1000),300)
+    for v in vals:
+      t.insert(v)
+      assert t.findnode(v).value == v
+    t.check()
+    s = sorted(vals,reverse=rev)
+    for v in vals[:50]: assert t.index(v) == s.index(v)
+    assert t.findnode(-1) is None and -1 not in t
+    for v in vals[:150]: t.remove(v)
+    t.check()
+    assert list(t) == sorted(vals[150:],reverse=rev)
+    left = t._split(lambda k: (k > 500) if rev else (k < 500))
+    left.check()
+    t.check()
+    assert all(left.findnode(v) is not None for v in left)
+    assert all(t.findnode(v) is not None for v in t)
+  # multiset: the index points at the first of a run of equal keys
+  t = pyRBT(hashindex=True)
+  for v in [3,1,3,2,3,1]: t.insert(v,True)
+  t.check()
+  assert t.index(3) == 3 and t.index(1) == 0
+  t.remove(3)
+  t.check()
+  assert t.index(3) == 3 and list(t) == [1,1,2,3,3]
+  left = t._split(lambda k: k < 3)
+  t.check()
+  left.check()
+  t.pop(0)
+  t.check()
+  t.clear()
+  t.check()
+  # maps, bounded trees and key functions
+  m = pyRBMap(hashindex=True,maxlen=10)
+  for i in range(30): m[i % 17] = i
+  m.check()
+  assert len(m) == 10 and m[16] == 16 and 0 not in m
+  assert m.pop(16) == 16 and m.get(16) is None
+  m.check()
+  t = pyRBT(['pear','fig','kiwi'],key=len,hashindex=True)
+  t.check()
+  assert t.findnode('date').value == 'kiwi'
+  try:
+    pyRBT(engine='bplus',hashindex=True)
+    assert False
+  except ValueError: pass
+
+def _test_lazy():
+  print("Testing lazy deletion...")
+  for (rev,multi,hidx) in [(False,False,False),(True,False,True),
+                           (False,True,False),(True,True,True)]:
+    t = pyRBT(reverse=rev,lazy=0.5,hashindex=hidx)
+    vals = []
+    for _ in range(600):
+      v = random.randrange(60)
+      if random.random() < 0.55:
+        if multi or v not in vals:
+          t.insert(v,multi)
+          vals.append(v)
+      elif v in vals:
+        assert t.remove(v) == v
+        vals.remove(v)
+      s = sorted(vals,reverse=rev)
+      assert list(t) == s and list(reversed(t)) == s[::-1]
+      if vals:
+        assert t[random.randrange(len(s))] in vals and t[-1] == s[-1]
+        assert t.index(v if v in vals else s[0]) == s.index(v if v in vals else s[0])
+        assert t.findnode(v) is None or t.findnode(v).value == v
+    t.check()
+    s = sorted(vals,reverse=rev)
+    left = t._split(lambda k: (k > 30) if rev else (k < 30))
+    left.check()
+    t.check()
+    assert list(left)+list(t) == s
+  # dead nodes are skipped by range queries and revived by insert
+  t = pyRBT(range(10),lazy=1)
+  for v in [3,4,5]: t.remove(v)
+  t.check()
+  assert t._ndead == 3 and len(t) == 7 and 4 not in t
+  assert t._floornode(4).value == 2 and t._ceilingnode(4).value == 6
+  assert [n.value for n in t._irange_nodes(2,7)] == [2,6,7]
+  t.insert(4)
+  t.check()
+  assert t._ndead == 2 and t.index(4) == 3 and t.index(6) == 4
+  t.compact()
+  t.check()
+  assert t._ndead == 0 and list(t) == [0,1,2,4,6,7,8,9]
+  # a plain insert replaces a live equal value before reviving a dead one
+  t = pyRBT(lazy=1)
+  t.insert(5,True)
+  t.insert(5,True)
+  assert t.pop(1) == 5
+  t.insert(5)
+  t.check()
+  assert list(t) == [5] and t._ndead == 1
+  for rev in [False,True]:
+    t,vals = pyRBT(lazy=1,reverse=rev),[]
+    for _ in range(400):
+      v = random.randrange(15)
+      r = random.random()
+      if r < 0.3:
+        t.insert(v,True)
+        vals.append(v)
+      elif r < 0.6:
+        t.insert(v)
+        if v not in vals: vals.append(v)
+      elif v in vals:
+        assert t.remove(v) == v
+        vals.remove(v)
+      assert list(t) == sorted(vals,reverse=rev) and (v in t) == (v in vals)
+    t.check()
+  # split a tree that still holds dead nodes
+  t = pyRBT(range(10),lazy=1)
+  for v in [2,5,6]: t.remove(v)
+  assert t._ndead == 3
+  left = t._split(lambda k: k < 5)
+  left.check()
+  t.check()
+  assert list(left) == [0,1,3,4] and list(t) == [7,8,9]
+  # maps and bounded trees
+  m = pyRBMap(lazy=0.3,maxlen=20)
+  for i in range(100):
+    m[i % 37] = i
+    if i % 3 == 0: m.pop(random.choice(list(m.keys())))
+    m.check()
+  assert len(m) <= 20 and m[list(m.keys())[0]] is not None
+  try:
+    pyRBT(lazy=0)
+    assert False
+  except ValueError: pass
+
+def _test_merge():
+  print("Testing k-way merge...")
+  shards = [ random.sample(range(200),random.randrange(40)) for _ in range(7) ]
+  allvals = sorted(v for sh in shards for v in sh)
+  for rev in [False,True]:
+    trees = [ pyRBT(sh,reverse=rev) for sh in shards ]
+    trees.append(_SmallBPT(shards[0],reverse=not rev)) # mixed order and engine
+    vals = sorted(allvals+shards[0],reverse=rev)
+    assert list(pyRBT.merge(*trees)) == vals
+    assert list(pyRBT.merge(*trees,reverse=True)) == vals[::-1]
+    assert list(pyRBT.merge(*trees,dedup=True)) == sorted(set(vals),reverse=rev)
+    t = pyRBT.merged(*trees)
+    t.check()
+    assert list(t) == sorted(set(vals),reverse=rev) and t.reverse == rev
+    t = pyRBT.merged(*trees,dedup=False)
+    t.check()
+    assert list(t) == vals
+  assert list(pyRBT.merge()) == [] and len(pyRBT.merged()) == 0
+  assert list(pyRBT.merge(pyRBT(),pyRBT([2,1]))) == [1,2]
+  # later maps win on equal keys
+  a = pyRBMap({1:'a',2:'a',4:'a'})
+  b = pyRBMap({2:'b',3:'b'},hashindex=True)
+  assert list(pyRBT.merge(a,b,dedup=True)) == [(1,'a'),(2,'b'),(3,'b'),(4,'a')]
+  m = pyRBMap.merged(b,a)
+  m.check()
+  assert list(m.items()) == [(1,'a'),(2,'a'),(3,'b'),(4,'a')] and m[3] == 'b'
+  assert list(a.union(b).items()) == list(pyRBMap.merged(a,b).items())
+  # merged keeps options such as the hash index and key function
+  t = pyRBT.merged(pyRBT(['bb','a'],key=len,hashindex=True),pyRBT(['ccc','d'],key=len))
+  t.check()
+  assert list(t) == ['d','bb','ccc'] and t.find('x') == 'd'
+  try:
+    pyRBT.merge(pyRBT(),dedupe=True)
+    assert False
+  except TypeError: pass
+
+def _test_node_identity():
+  print("Testing nodes keep their identity through rebalancing...")
+  for rev in [False,True]:
+    t = pyRBT(reverse=rev)
+    vals = random.sample(range(1000),300)
+    for v in vals: t.insert(v)
+    nodes = dict((v,t.findnode(v)) for v in vals)
+    random.shuffle(vals)
+    for v in vals[:200]:
+      assert t.remove(v) == v
+      del nodes[v]
+    t.check()
+    for (v,node) in nodes.items():
+      assert t.findnode(v) is node and node.value == v
+    assert t.root.isleaf() is False and pyRBT._leaf.size == 0
+
+def _test_changes():
+  print("Testing change log, diff and apply...")
+  for engine in ['rbt','bplus']:
+    for rev in [False,True]:
+      m = pyRBMap(reverse=rev,engine=engine,changelog=100)
+      replica = pyRBMap(reverse=rev,engine=engine)
+      v0 = m.version
+      for i in range(300):
+        k = random.randrange(50)
+        if random.random() < 0.6: m[k] = i
+        elif k in m: del m[k]
+        if i % 50 == 49:
+          replica.apply(m.changes_since(v0))
+          v0 = m.version
+          assert list(replica.items()) == list(m.items())
+      m.popitem()
+      m.clear()
+      m.update({1:'a',2:'b'})
+      replica.apply(m.changes_since(v0))
+      assert list(replica.items()) == [(2,'b'),(1,'a')] if rev else [(1,'a'),(2,'b')]
+      assert m.changes_since(m.version) == []
+      try:
+        m.changes_since(0)
+        assert False
+      except ValueError: pass
+  # diff of two trees, applied to the second, reproduces the first
+  a = pyRBMap(dict((random.randrange(100),random.randrange(3)) for _ in range(60)))
+  b = pyRBMap(dict((random.randrange(100),random.randrange(3)) for _ in range(60)),
+              reverse=True)
+  d = a.diff_against(b)
+  assert all(op == 'set' for (op,k,v) in d if k in a)
+  assert all(op == 'del' and k in b for (op,k,v) in d if k not in a)
+  b.apply(d)
+  b.check()
+  assert sorted(b.items()) == sorted(a.items()) and a.diff_against(b) == []
+  # sets, with few changes applied one by one and key functions
+  t = pyRBT(range(0,1000,2),changelog=10)
+  u = pyRBT(range(0,1000,2))
+  v0 = t.version
+  t.remove(10)
+  t.insert(11)
+  t._split(lambda x: x < 4)
+  u.apply(t.changes_since(v0))
+  u.check()
+  assert list(u) == list(t) and len(t.changes_since(v0)) == 4
+  s = pyRBT(['pear','fig'],key=len)
+  s.apply([('set','kiwi',None),('del','abc',None),('set','plum',None)])
+  assert list(s) == ['plum']
+
+def _test_rank_select():
+  print("Testing rank and select on maps...")
+  for (rev,engine,lazy) in [(False,'rbt',None),(True,'rbt',0.5),
+                            (False,'bplus',None),(True,'bplus',None)]:
+    m = pyRBMap(reverse=rev,engine=engine,lazy=lazy)
+    ks = random.sample(range(0,2000,2),400)
+    for k in ks: m[k] = -k
+    for k in ks[:100]: del m[k]
+    order = sorted(ks[100:],reverse=rev)
+    for i in [0,1,150,len(order)-1,-1,-len(order)]:
+      assert m.key_at(i) == order[i] and m.item_at(i) == (order[i],-order[i])
+    for k in [order[0],order[7],-1,1,999,2001]:
+      assert m.rank(k) == sum(1 for x in order if (x > k if rev else x < k))
+    for (i,j) in [(0,10),(5,5),(290,400),(-20,-3),(10,2),(None,4)]:
+      exp = [ (k,-k) for k in order[i:j] ]
+      assert list(m.items_between_ranks(i,j)) == exp and m[i:j] == exp
+    assert m[3:40:7] == [ (k,-k) for k in order[3:40:7] ]
+    assert m.pop_at(5) == (order[5],-order[5]) and order[5] not in m
+    m.check()
+  try:
+    pyRBMap().item_at(0)
+    assert False
+  except IndexError: pass
+  t = pyRBT([5,1,3])
+  assert t.rank(3) == 1 and t.rank(4) == 2 and t.rank(0) == 0 and t.rank(9) == 3
+
+def _test_key():
+  print("Testing key= and reverse=...")
+  words = ['pear','fig','banana','kiwi','apple']
+  t = pyRBT(words,key=len)
+  t.check()
+  assert list(t) == ['fig','kiwi','apple','banana'] # same length replaces
+  t = pyRBT(key=len)
+  t.extend(words,multiset=True)
+  t.check()
+  assert [len(w) for w in t] == sorted(len(w) for w in words)
+  assert t.index('abcd') == 1 and 'zzzzz' in t and 'zzz' in t
+  assert t.find('abcdefgh') is None
+  r = pyRBT(range(10),reverse=True)
+  r.check()
+  assert list(r) == list(range(9,-1,-1))
+  assert r[0] == 9 and r.index(7) == 2 and r.remove(4) == 4
+  assert list(reversed(r)) == [0,1,2,3,5,6,7,8,9]
+  r = pyRBT(key=lambda x: -x,reverse=True)
+  r.extend([5,1,3,1],multiset=True)
+  r.check()
+  assert list(r) == [1,1,3,5] and r.index(3) == 2
+  # set operations keep the ordering of the left tree
+  a,b = pyRBT(range(0,10),reverse=True),pyRBT(range(7,20),reverse=True)
+  assert list(a.intersect(b)) == [9,8,7]
+  assert list(a.diff(b)) == list(range(6,-1,-1))
+  assert list(a.union(b)) == list(range(19,-1,-1))
+  assert list(a.symmetric_diff(b)) == list(range(19,9,-1))+list(range(6,-1,-1))
+  for eng in ['rbt','bplus']:
+    a,b = pyRBT([1,2,3,4],engine=eng),pyRBT([3,4,5],reverse=True,engine=eng)
+    assert list(a.intersect(b)) == [3,4] and list(b.intersect(a)) == [4,3]
+    assert list(a.diff(b)) == [1,2] and list(b.diff(a)) == [5]
+    assert list(a.symmetric_diff(b)) == [1,2,5]
+    assert list(b.symmetric_diff(a)) == [5,2,1]
+    assert list(a.union(b)) == [1,2,3,4,5]
+  m = pyRBMap({'b':2,'a':1,'c':3},reverse=True)
+  m.check()
+  assert list(m.keys()) == ['c','b','a'] and m['a'] == 1 and 'b' in m
+  m = pyRBMap(key=lambda k: k[1])
+  m[(1,'y')] = 1
+  m[(2,'x')] = 2
+  assert list(m.keys()) == [(2,'x'),(1,'y')]
+  # a sort key of None is cached as None, not replaced by the value
+  t = pyRBT([7],key=lambda x: None)
+  assert t.root.key is None and list(t) == [7]
+  m = pyRBMap(hashindex=True)
+  m[None] = 1
+  assert m.root.key is None and m[None] == 1 and list(m.items()) == [(None,1)]
+
 def _test_del():
   t = pyRBT()
   t.extend([1,2,3,4,5])
@@ -238,6 +839,19 @@ def main():
   _test_intersect()
   _test_symmetric_diff()
   _test_map()
+  _test_key()
+  _test_map_views()
+  _test_bounded()
+  _test_bplus()
+  _test_journal()
+  _test_split()
+  _test_ttl_map()
+  _test_hashindex()
+  _test_lazy()
+  _test_merge()
+  _test_node_identity()
+  _test_changes()
+  _test_rank_select()
 
   # Insert [1,2,...,N]
   _test_rbt_autotests()